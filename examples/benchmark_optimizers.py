@@ -0,0 +1,24 @@
+import sys, random
+from ase.db import connect
+from ase.calculators.emt import EMT
+from caxpert.src.tasks.relax import benchmark_optimizers
+
+# Compare the optimizers on structures sampled from the enumerated Ni(111) CO/H set (init_structures.db, see structure_enumeration.py).
+# Usage: python benchmark_optimizers.py [structure number] [checkpoint path]
+# EMT is used when no checkpoint is given, it is only meant to compare the optimizers' relative cost.
+
+structure_num = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+if len(sys.argv) > 2:
+    from caxpert.src.tasks.inference import get_calculator
+    calc = get_calculator(sys.argv[2], trainer='equiformerv2_forces')
+else:
+    calc = EMT()
+
+with connect('init_structures.db') as db:
+    ids = [row.id for row in db.select('natoms<=40', columns=['id'], include_data=False)]
+    random.seed(0)
+    structures = [db.get(id=i).toatoms() for i in random.sample(ids, min(structure_num, len(ids)))]
+
+results = benchmark_optimizers(structures, calc, fmax=0.05, steps=300, optimizer_kwargs={'LBFGS': {'memory': 20}})
+fastest = min(results, key=lambda name: results[name]['time'])
+print(f'The fastest optimizer is {fastest}.')
@@ -0,0 +1,83 @@
+import sys, time
+import numpy as np
+from ase.build import fcc111, molecule, add_adsorbate
+from ase.constraints import FixAtoms
+from icet.tools import enumerate_structures
+from caxpert.src.tasks.gen_str import decorate_structure, make_adsorbate_templates
+from caxpert.src.utils.utils import elements_place_holder
+
+# Benchmark the adsorbate placement of generate_structures against the previous
+# implementation, which deleted every place holder atom and called add_adsorbate once per site.
+# Usage: python benchmark_placement.py [cell_size]
+
+def legacy_decorate_structure(struct, ads_identities, surface_z, surface_z_coords, top_layer_atom_index, fixed_layers=None, mag_ms=None):
+    cov = dict()
+    top_layer_atom_num = 0
+    for ads in ads_identities.values():
+        cov[ads[0].get_chemical_formula().lower()] = 0
+    struct_to_db = struct.copy()
+    struct_to_db.info['adsorbate_info'] = {'top layer atom index':top_layer_atom_index}
+    for i in sorted(range(len(struct)),reverse=True):
+        atom = struct[i]
+        if atom.symbol == 'X':
+            del struct_to_db[i]
+        elif atom.symbol in ads_identities.keys():
+            del struct_to_db[i]
+            add_adsorbate(struct_to_db, ads_identities[atom.symbol][0], atom.position[2]-surface_z, position=atom.position[:2], mol_index=ads_identities[atom.symbol][1])
+            cov[ads_identities[atom.symbol][0].get_chemical_formula().lower()] += 1
+        else:
+            if atom.position[2] in surface_z_coords:
+                top_layer_atom_num += 1
+                struct_to_db[i].tag = 1
+            else:
+                struct_to_db[i].tag = 0
+    for ads in cov.keys():
+        cov[ads] = round(cov[ads]/top_layer_atom_num, 3)
+    if fixed_layers:
+        struct_to_db.set_constraint(FixAtoms([a.index for a in struct_to_db if round(a.z, 2) in fixed_layers]))
+    if mag_ms:
+        for a in struct_to_db:
+            if a.tag != 2:
+                a.magmom = mag_ms[a.symbol]
+    return struct_to_db, dict(top_layer_atom_index=top_layer_atom_index, **cov)
+
+cell_size = int(sys.argv[1]) if len(sys.argv) > 1 else 9
+
+prim_structure = fcc111('Ni',size=(1,1,4), vacuum=13)
+fix_layer = prim_structure[1].position[2]
+prim_structure.set_tags([0 for i in range(len(prim_structure))])
+prim_structure[3].tag = 1
+fixed_layers = [round(a.z, 2) for a in prim_structure if a.z <= fix_layer]
+surface_z = prim_structure[3].z
+surface_z_coords = set([surface_z])
+mag_ms = {'Ni': 10.8}
+co = molecule('CO', vacuum=13, tags=[2,2])
+h = molecule('H', vacuum=13, tags=[2])
+ads_identities = {elements_place_holder[0]: (co, 1), elements_place_holder[1]: (h, 0)}
+add_adsorbate(prim_structure, co, 1.8, position='fcc', offset=(0, 0), mol_index=1)
+prim_structure[-1].symbol = 'O'
+del prim_structure[-2]
+species = [[a.symbol] if a.tag != 2 else ['X'] + list(ads_identities.keys()) for a in prim_structure]
+structs = list(enumerate_structures(prim_structure, range(1, cell_size), species))
+atom_num = sum(len(s) for s in structs)
+print(f'{len(structs)} enumerated structures with {atom_num} atoms in total')
+
+start_time = time.perf_counter()
+legacy = [legacy_decorate_structure(s, ads_identities, surface_z, surface_z_coords, 3, fixed_layers, mag_ms) for s in structs]
+legacy_time = time.perf_counter() - start_time
+
+start_time = time.perf_counter()
+templates = make_adsorbate_templates(ads_identities)
+vectorized = [decorate_structure(s, templates, surface_z_coords, 3, fixed_layers, mag_ms) for s in structs]
+vectorized_time = time.perf_counter() - start_time
+
+for (a1, kvp1), (a2, kvp2) in zip(legacy, vectorized):
+    assert kvp1 == kvp2
+    assert (a1.numbers == a2.numbers).all() and np.allclose(a1.positions, a2.positions)
+    assert (a1.get_tags() == a2.get_tags()).all()
+    assert np.allclose(a1.get_initial_magnetic_moments(), a2.get_initial_magnetic_moments())
+    assert (a1.constraints[0].index == a2.constraints[0].index).all()
+
+print(f'per-atom add_adsorbate: {legacy_time:.3f} s ({len(structs)/legacy_time:.1f} structures/s)')
+print(f'vectorized placement: {vectorized_time:.3f} s ({len(structs)/vectorized_time:.1f} structures/s)')
+print(f'speedup: {legacy_time/vectorized_time:.1f}x')
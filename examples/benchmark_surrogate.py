@@ -0,0 +1,26 @@
+import sys, random
+from ase.db import connect
+from ase.calculators.emt import EMT
+from caxpert.src.tasks.run_dft import benchmark_surrogate
+
+# Measure the DFT steps saved by relaxing with a surrogate first, on structures sampled from init_structures.db (see structure_enumeration.py).
+# Usage: python benchmark_surrogate.py [structure number] [checkpoint path]
+# EMT stands in for DFT, replace make_calculator with an Espresso calculator (see start_dfts.py) for the real numbers.
+# The surrogate is the fine-tuned model when a checkpoint is given, EMT with the ASAP cutoff otherwise.
+
+structure_num = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+if len(sys.argv) > 2:
+    from caxpert.src.tasks.inference import get_calculator
+    surrogate = get_calculator(sys.argv[2], trainer='equiformerv2_forces')
+else:
+    surrogate = EMT(asap_cutoff=True)
+
+def make_calculator(directory):
+    return EMT()
+
+with connect('init_structures.db') as db:
+    ids = [row.id for row in db.select('natoms<=40', columns=['id'], include_data=False)]
+    random.seed(0)
+    structures = [db.get(id=i).toatoms() for i in random.sample(ids, min(structure_num, len(ids)))]
+
+benchmark_surrogate(structures, make_calculator, surrogate, fmax=0.03)
@@ -1,4 +1,5 @@
 from caxpert.src.tasks.make_db import MakeTrainingDB
+from caxpert.src.utils.frame_selection import FrameSelector
 import subprocess, os
 import fairchem.core.common.tutorial_utils as utils
 from caxpert.src.utils.utils import add_fw
@@ -8,7 +9,11 @@ def get_traj_paths(parent_p):
 co_h_traj_paths = get_traj_paths('dft_relax')
 h_traj_paths = get_traj_paths('dft_relax_h_only')
 co_h_traj_paths.extend(h_traj_paths)
-MakeTrainingDB(co_h_traj_paths, 'slabs.db', 'gas_ref.db').create_ase_database()
+# all the frames are written, as before the frame selection was added
+selector = FrameSelector()
+# opt in to skip the late BFGS frames that barely change the energy, once the threshold is validated against the fine-tuning accuracy
+# selector = FrameSelector(energy_change=0.005)
+MakeTrainingDB(co_h_traj_paths, 'slabs.db', 'gas_ref.db', frame_selector=selector).create_ase_database(processes=os.cpu_count())
 os.makedirs('training_data/datasets', exist_ok=True)
 utils.train_test_val_split('training_data/ml_train.db', (0.8, 0.1, 0.1),('training_data/datasets/train.db','training_data/datasets/val.db', 'training_data/datasets/test.db'))
 
@@ -0,0 +1,21 @@
+import os, sys
+from ase.db import connect
+from caxpert.src.tasks.inference import ml_relax_queue
+from caxpert.src.utils.work_queue import WorkQueue
+
+# Relax the enumerated structures with workers claiming ids from a shared queue.
+# Fill the queue once: python run_inf_queue.py fill
+# Then start any number of workers, e.g. in a SLURM job array: python run_inf_queue.py $SLURM_ARRAY_TASK_ID
+
+input_db = 'init_structures.db'
+queue_db = 'ml_inf_queue.sqlite'
+checkpoint_path = 'eq2_31M_ec4_allmd.pt'
+
+if sys.argv[1] == 'fill':
+    with connect(input_db) as db:
+        WorkQueue(queue_db).add(row.id for row in db.select(columns=['id']))
+    print(WorkQueue(queue_db).counts())
+else:
+    os.makedirs('ml_inf', exist_ok=True)
+    ml_relax_queue(input_db, checkpoint_path, queue_db, int(sys.argv[1]), output_path='ml_inf', claim_size=32,
+                   reclaim_after=4 * 3600, fmax=0.03, steps=300, batch_size=16)
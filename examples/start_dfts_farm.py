@@ -0,0 +1,59 @@
+import os, sys, logging
+from ase.calculators.espresso import Espresso
+from caxpert.src.tasks.job_farm import run_job_farm
+
+# Relax all the structures under the given directories in one job, e.g. a single allocation split between the relaxations.
+# Usage: python start_dfts_farm.py max_jobs dir [dir ...]
+# Each structure is dir/{NAME}/init.traj and is relaxed in dir/{NAME}, the pw.x command shares the nodes between the jobs.
+
+logging.basicConfig(level=logging.INFO)
+
+espresso_settings = {
+    'control': {
+        'verbosity': 'high',
+        'calculation': 'scf',
+        'pseudo_dir': '/global/homes/x/xuchao/espresso/pseudo',
+        'disk_io': 'none'
+    },
+    'system': {
+        'input_dft': 'RPBE',
+        'occupations': 'smearing',
+        'smearing': 'mv',
+        'degauss': 0.01,
+        'ecutwfc': 40,
+        'nspin': 2,
+    },
+    'electrons': {
+        'electron_maxstep': 200,
+        'mixing_mode': 'local-TF',
+        'mixing_beta': 0.5,
+        'diagonalization': 'cg',
+    },
+}
+command = "srun --exact -n 32 pw.x -npool 1 -ndiag 1 -input espresso.pwi > espresso.pwo"
+pseudopotentials = {
+                        'Ni': 'Ni_ONCV_PBE-1.2.upf',
+                        'C': 'C_ONCV_PBE-1.2.upf',
+                        'O': 'O_ONCV_PBE-1.2.upf',
+                        'H': 'H_ONCV_PBE-1.2.upf',
+                        }
+kpts=(5, 5, 1)
+
+def make_calculator(directory):
+    return Espresso(
+                command=command,
+                pseudopotentials=pseudopotentials,
+                tstress=True,
+                tprnfor=True,
+                kpts=kpts,
+                input_data=espresso_settings,
+                disk_io='none',
+                directory=directory
+                )
+
+if __name__ == '__main__':
+    max_jobs = int(sys.argv[1])
+    init_trajs = [os.path.join(d, i, 'init.traj') for d in sys.argv[2:] for i in sorted(os.listdir(d))
+                  if os.path.exists(os.path.join(d, i, 'init.traj'))]
+    states = run_job_farm(init_trajs, make_calculator, max_jobs=max_jobs, retries=1, fmax=0.05)
+    print([t for t, state in states.items() if state == 'failed'])
@@ -1,19 +1,23 @@
-import random, os, logging
+import random, os, logging, time, hashlib, sqlite3
 import numpy as np
+import spglib
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 from ase.io.trajectory import Trajectory
 from ase.db import connect
 from ase.atom import Atom
 from ase.atoms import Atoms
-from ase.build.surface import add_adsorbate
+from ase.data import atomic_numbers, chemical_symbols
 from ase.constraints import FixAtoms
 from ase.io import write
 from icet.tools import enumerate_structures
 from ..utils.error import AdsorbatesNotTaggedError, TooManyAdsorbatesError, NoStructureMatchQueryError, SurfaceNotTaggedError, BulkTagError 
-from ..utils.utils import elements_place_holder, is_generator_empty
+from ..utils.utils import elements_place_holder, reservoir_sample, stratified_sample, coverage_bin
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def generate_structures(prim_structure, adsorbates, ads_center_atom_ids, cell_size, db_path='init_structures.db', elements_place_holder=elements_place_holder, fixed_layers=None):
+def generate_structures(prim_structure, adsorbates, ads_center_atom_ids, cell_size, db_path='init_structures.db', elements_place_holder=elements_place_holder, fixed_layers=None, chunk_size=1000, processes=1, resume=False, skip_stored=False):
     """
     This function enumerates structures using the Cluster Expansion Tool (ICET).
     prim_structure: ase.atom.Atoms or ase.atom.Atom or str
@@ -29,6 +33,23 @@ def generate_structures(prim_structure, adsorbates, ads_center_atom_ids, cell_si
         The path to the ASE database to store the structures
     elements_place_holder: list
         The list of elements to use as place holders for adsorbates in the enumeration.
+    fixed_layers: list
+        The z coordinates (rounded to 2 decimals) of the layers to fix, ignored if the primitive structure has a FixAtoms constraint.
+    chunk_size: int
+        The number of structures buffered in memory and committed to the database in a single transaction.
+    processes: int
+        The number of worker processes decorating the enumerated structures with adsorbates,
+        the structures are still written to the database by the calling process only.
+    resume: bool
+        A flag to resume an interrupted enumeration. The number of structures committed for each supercell size
+        is recorded in the database metadata together with each chunk, if set to True, the completed sizes and
+        the structures already stored are skipped.
+    skip_stored: bool
+        A flag to skip the enumerated structures already stored in db_path, e.g. when enumerating again into the same database
+        with a larger cell_size or after an interrupted run without resume, and to count how many times each one was enumerated.
+        It does not shrink a first enumeration, ICET already enumerates a single structure for each set of structures
+        equivalent under the symmetry of the primitive structure. Each stored structure gets a "fingerprint" key identifying it
+        up to the surface symmetry and the lattice translations, and a "times_enumerated" key.
     """
     if len(adsorbates) > len(elements_place_holder):
         raise TooManyAdsorbatesError('Toom many adsorbates to enumerate, make it less than the elements_place_holder (default is 6).')
@@ -93,46 +114,346 @@ def generate_structures(prim_structure, adsorbates, ads_center_atom_ids, cell_si
             species.append(pool)
         else:
             species.append([atom.symbol])
-    generated_structures = enumerate_structures(prim_structure, range(1, cell_size), species)
+    symmetry = get_surface_symmetry(prim_structure) if skip_stored else None
+    decorate = partial(decorate_structure, templates=make_adsorbate_templates(ads_identities), surface_z_coords=surface_z_coords,
+                       top_layer_atom_index=top_layer_atom_index, fixed_layers=fixed_layers, mag_ms=mag_ms, symmetry=symmetry)
+    db = connect(db_path)
+    equivalence_classes = dict()
+    if skip_stored:
+        for fingerprint, (_, times_enumerated) in get_equivalence_classes(db_path).items():
+            equivalence_classes[fingerprint] = {'times_enumerated': times_enumerated}
+    skipped_num = 0
+    progress = {'species': species, 'sizes': dict()}
+    if resume:
+        progress = db.metadata.get('enumeration', progress)
+        if progress['species'] != species:
+            raise ValueError(f'The enumeration stored in {db_path} was started with different species, it can not be resumed.')
+    struct_num = 0
+    start_time = time.perf_counter()
+    for size in range(1, cell_size):
+        size_progress = progress['sizes'].setdefault(str(size), {'index': 0, 'complete': False})
+        if size_progress['complete']:
+            logging.info(f'The structures of supercell size {size} are already stored, skip it.')
+            continue
+        generated_structures = enumerate_structures(prim_structure, [size], species)
+        if size_progress['index']:
+            logging.info(f'Resume supercell size {size} after {size_progress["index"]} stored structures.')
+            generated_structures = islice(generated_structures, size_progress['index'], None)
+        for chunk in decorate_chunks(generated_structures, decorate, chunk_size, processes):
+            size_progress['index'] += len(chunk)
+            enumeration_counts = dict()
+            if skip_stored:
+                enumerated_num = len(chunk)
+                chunk, enumeration_counts = drop_duplicates(chunk, equivalence_classes)
+                skipped_num += enumerated_num - len(chunk)
+            struct_num += write_chunk(db, chunk, metadata={'enumeration': progress}, enumeration_counts=enumeration_counts)
+            log_throughput(struct_num, start_time)
+        size_progress['complete'] = True
+        db.metadata = dict(db.metadata, enumeration=progress)
+    create_natoms_index(db_path)
+    if skip_stored:
+        logging.info(f'{skipped_num} structures already stored have been skipped.')
+    logging.info('The structures have been generated and stored in the database.')
+
+def make_adsorbate_templates(ads_identities):
+    """
+    Precompute the adsorbate templates used to place the adsorbates on the enumerated structures.
+    The atoms of all the adsorbates are stacked in flat arrays, the positions are stored as offsets
+    from the atom binding to the surface so an adsorbate is placed by adding the position of its site.
+    ads_identities: dict, {str: (ase.Atoms, int)}
+        The adsorbates (value) represented by each place holder element (key).
+    Returns:
+        dict: the stacked adsorbate arrays, with the following keys:
+            - "names" (list): the adsorbate names used as coverage keys, in the place holder order.
+            - "type_index" (numpy.ndarray): the adsorbate index of each atomic number, -1 if the number is not a place holder.
+            - "start", "length" (numpy.ndarray): the first row and number of atoms of each adsorbate in the stacked arrays.
+            - "offsets", "numbers", "magmoms" (numpy.ndarray): the stacked atom offsets, atomic numbers and initial magnetic moments.
+    """
+    names = []
+    type_index = np.full(len(atomic_numbers), -1, dtype=int)
+    offsets, numbers, magmoms, length = [], [], [], []
+    for i, (place_holder, (ads, mol_index)) in enumerate(ads_identities.items()):
+        names.append(ads.get_chemical_formula().lower())
+        type_index[atomic_numbers[place_holder]] = i
+        offsets.append(ads.positions - ads.positions[mol_index])
+        numbers.append(ads.numbers)
+        magmoms.append(ads.get_initial_magnetic_moments())
+        length.append(len(ads))
+    length = np.array(length, dtype=int)
+    return {
+        'names': names,
+        'type_index': type_index,
+        'start': np.cumsum(length) - length,
+        'length': length,
+        'offsets': np.concatenate(offsets),
+        'numbers': np.concatenate(numbers),
+        'magmoms': np.concatenate(magmoms),
+    }
+
+def decorate_structure(struct, templates, surface_z_coords, top_layer_atom_index, fixed_layers=None, mag_ms=None, symmetry=None):
+    """
+    Replace the place holder atoms of an enumerated structure with the adsorbates, tag the atoms and set the constraints and magnetic moments.
+    The final arrays are built in a single pass and the Atoms object is constructed once,
+    the atom order is the slab atoms followed by the adsorbates in the reversed order of their sites.
+    struct: ase.Atoms
+        The structure enumerated by ICET.
+    templates: dict
+        The adsorbate templates made by make_adsorbate_templates.
+    surface_z_coords: set
+        The z coordinates of the surface atoms in the primitive structure.
+    top_layer_atom_index: int
+        The index of an atom in the top layer, stored in the database with the structure.
+    fixed_layers: list
+        The z coordinates (rounded to 2 decimals) of the layers to fix.
+    mag_ms: dict, {str: float}
+        The initial magnetic moment of each element of the slab.
+    symmetry: dict
+        The surface symmetry made by get_surface_symmetry, if provided, the fingerprint of the
+        adsorbate site occupations is added to the key_value_pairs with times_enumerated set to 1.
+    Returns:
+        tuple: (ase.Atoms, dict), the decorated structure and its key_value_pairs.
+    """
+    numbers = struct.numbers
+    positions = struct.positions
+    site_types = templates['type_index'][numbers]
+    # the vacancies ('X') have the atomic number 0
+    slab_mask = (site_types < 0) & (numbers != 0)
+    sites = np.nonzero(site_types >= 0)[0][::-1]
+    site_types = site_types[sites]
+
+    slab_numbers = numbers[slab_mask]
+    slab_positions = positions[slab_mask]
+    slab_tags = np.isin(slab_positions[:, 2], list(surface_z_coords)).astype(int)
+    top_layer_atom_num = np.count_nonzero(slab_tags)
+    if mag_ms:
+        slab_magmoms = np.array([mag_ms[chemical_symbols[n]] for n in slab_numbers], dtype=float)
+    else:
+        slab_magmoms = struct.get_initial_magnetic_moments()[slab_mask]
+
+    # row of each adsorbate atom in the stacked templates
+    length = templates['length'][site_types]
+    rows = np.repeat(templates['start'][site_types], length) + np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+    ads_positions = np.repeat(positions[sites], length, axis=0) + templates['offsets'][rows]
+
+    magmoms = np.concatenate([slab_magmoms, templates['magmoms'][rows]])
+    struct_to_db = Atoms(
+        numbers=np.concatenate([slab_numbers, templates['numbers'][rows]]),
+        positions=np.concatenate([slab_positions, ads_positions]),
+        tags=np.concatenate([slab_tags, np.full(len(rows), 2)]),
+        magmoms=magmoms if magmoms.any() else None,
+        cell=struct.cell,
+        pbc=struct.pbc,
+    )
+    struct_to_db.info['adsorbate_info'] = {'top layer atom index':top_layer_atom_index}
+
+    ads_counts = np.bincount(site_types, minlength=len(templates['names']))
+    cov = dict()
+    for name, count in zip(templates['names'], ads_counts):
+        cov[name] = round(int(count)/top_layer_atom_num, 3)
+
+    if fixed_layers:
+        constraint = FixAtoms(np.nonzero(np.isin(np.round(struct_to_db.positions[:, 2], 2), fixed_layers))[0])
+        struct_to_db.set_constraint(constraint)
+    else:
+        logging.warning('No fixed layers are provided.')
+    key_value_pairs = dict(top_layer_atom_index=top_layer_atom_index, **cov)
+    if symmetry is not None:
+        key_value_pairs['fingerprint'] = site_fingerprint(struct, symmetry, [0] + list(np.nonzero(templates['type_index'] >= 0)[0]))
+        key_value_pairs['times_enumerated'] = 1
+    return struct_to_db, key_value_pairs
+
+def get_surface_symmetry(prim_structure, symprec=1e-3):
+    """
+    Get the symmetry operations of the primitive structure that keep the surface normal, used to fingerprint the enumerated structures.
+    prim_structure: ase.Atoms
+        The primitive structure with a single atom on each adsorbate site.
+    symprec: float
+        The tolerance passed to spglib.
+    Returns:
+        dict: the primitive cell (key "cell") and the rotations and translations (keys "rotations" and "translations")
+        of the operations in fractional coordinates of the primitive cell.
+    """
+    dataset = spglib.get_symmetry((prim_structure.cell[:], prim_structure.get_scaled_positions(), prim_structure.numbers), symprec=symprec)
+    rotations = []
+    translations = []
+    for rotation, translation in zip(dataset['rotations'], dataset['translations']):
+        # the operations mixing the surface normal with the in-plane directions do not apply to slabs
+        if (rotation[2] == [0, 0, 1]).all() and (rotation[:, 2] == [0, 0, 1]).all():
+            rotations.append(rotation)
+            translations.append(translation)
+    return {'cell': prim_structure.cell[:], 'rotations': np.array(rotations), 'translations': np.array(translations)}
+
+def site_fingerprint(struct, symmetry, site_numbers, tolerance=1e-3):
+    """
+    Compute a fingerprint of the adsorbate site occupations of an enumerated structure that is the same
+    for all the structures equivalent under the surface symmetry operations and the lattice translations of its supercell.
+    The fingerprint hashes the supercell and the lexicographically smallest occupation vector over all the site permutations
+    generated by the symmetry operations, so only structures in the same supercell can share a fingerprint.
+    The structures of a single ICET enumeration all have different fingerprints, it recognizes the structures stored by an earlier run.
+    struct: ase.Atoms
+        The structure enumerated by ICET, with place holder atoms on the adsorbate sites.
+    symmetry: dict
+        The surface symmetry made by get_surface_symmetry.
+    site_numbers: list
+        The atomic numbers occupying the adsorbate sites, including the vacancies ('X', 0).
+    tolerance: float
+        The tolerance in fractional coordinates to match the sites.
+    Returns:
+        str: the fingerprint.
+    """
+    supercell = struct.cell[:]
+    sites = np.nonzero(np.isin(struct.numbers, site_numbers))[0]
+    # order the sites by their wrapped position so the occupation vector does not depend on the atom order
+    wrapped = np.round(struct.positions[sites] @ np.linalg.inv(supercell), 3) % 1
+    sites = sites[np.lexsort(wrapped.T[::-1])]
+    occupations = struct.numbers[sites]
+    site_positions = struct.positions[sites] @ np.linalg.inv(supercell)
+    prim_positions = struct.positions[sites] @ np.linalg.inv(symmetry['cell'])
+    # the operations in the fractional coordinates of the supercell
+    to_supercell = symmetry['cell'] @ np.linalg.inv(supercell)
+    supercell_matrix = np.round(supercell @ np.linalg.inv(symmetry['cell'])).astype(int)
+    canonical = tuple(occupations)
+    for rotation, translation in zip(symmetry['rotations'], symmetry['translations']):
+        # only the rotations keeping the supercell lattice map the periodic structure onto itself
+        supercell_rotation = supercell_matrix @ rotation.T @ np.linalg.inv(supercell_matrix)
+        if not np.allclose(supercell_rotation, np.round(supercell_rotation), atol=tolerance):
+            continue
+        rotated = (prim_positions @ rotation.T + translation) @ to_supercell
+        for shift in site_positions - rotated[0]:
+            diff = rotated[:, None, :] + shift - site_positions[None, :, :]
+            diff -= np.round(diff)
+            matches = np.all(np.abs(diff) < tolerance, axis=2)
+            if not (matches.sum(axis=1) == 1).all():
+                continue
+            permutation = np.argmax(matches, axis=1)
+            permuted = np.empty_like(occupations)
+            permuted[permutation] = occupations
+            canonical = min(canonical, tuple(permuted))
+    return hashlib.sha1(repr((supercell_matrix.tolist(), [int(i) for i in canonical])).encode()).hexdigest()
+
+def drop_duplicates(chunk, equivalence_classes):
+    """
+    Drop the structures of a chunk whose fingerprint is already in the equivalence classes and count them in the times_enumerated of their class.
+    chunk: list
+        A list of (ase.Atoms, dict) tuples, the dict holds the key_value_pairs of the structure with the "fingerprint" and "times_enumerated" keys.
+    equivalence_classes: dict, {str: dict}
+        The key_value_pairs of the structure representing each fingerprint, updated in place.
+    Returns:
+        tuple: (list, dict), the new structures of the chunk and the new times_enumerated of the classes stored in previous chunks.
+    """
+    unique = []
+    enumeration_counts = dict()
+    chunk_fingerprints = set()
+    for atoms, key_value_pairs in chunk:
+        fingerprint = key_value_pairs['fingerprint']
+        if fingerprint in equivalence_classes:
+            equivalence_classes[fingerprint]['times_enumerated'] += 1
+            if fingerprint not in chunk_fingerprints:
+                enumeration_counts[fingerprint] = equivalence_classes[fingerprint]['times_enumerated']
+        else:
+            equivalence_classes[fingerprint] = key_value_pairs
+            chunk_fingerprints.add(fingerprint)
+            unique.append((atoms, key_value_pairs))
+    return unique, enumeration_counts
+
+def get_equivalence_classes(db_path):
+    """
+    Read the equivalence classes of the structures stored with generate_structures(..., skip_stored=True).
+    Only the first structure of each class is written to the database, the structures enumerated again are dropped before they get an id,
+    so a class is its representative and the number of times it was enumerated, counted in its "times_enumerated" key.
+    db_path: str
+        The path to the ASE database where the structures are stored.
+    Returns:
+        dict: {fingerprint: (id, times_enumerated)}, the id of the structure representing each class and the number of times it was enumerated.
+    """
+    equivalence_classes = dict()
     with connect(db_path) as db:
-        cov = dict()
-        for struct in generated_structures:
-            top_layer_atom_num = 0
-            for ads in ads_identities.values():
-                cov[ads[0].get_chemical_formula().lower()] = 0
-            struct_to_db = struct.copy()
-            struct_to_db.info['adsorbate_info'] = {'top layer atom index':top_layer_atom_index}
-            # replace the place holder atoms with the adsorbates
-            for i in sorted(range(len(struct)),reverse=True):
-                atom = struct[i]
-                if atom.symbol == 'X':
-                    del struct_to_db[i]
-                elif atom.symbol in ads_identities.keys():
-                    del struct_to_db[i]
-                    add_adsorbate(struct_to_db, ads_identities[atom.symbol][0], atom.position[2]-surface_z, position=atom.position[:2], mol_index=ads_identities[atom.symbol][1])
-                    cov[ads_identities[atom.symbol][0].get_chemical_formula().lower()] += 1
-                else:
-                    if atom.position[2] in surface_z_coords:
-                        top_layer_atom_num += 1
-                        struct_to_db[i].tag = 1
-                    else:
-                        struct_to_db[i].tag = 0
-            for ads in cov.keys():
-                cov[ads] = round(cov[ads]/top_layer_atom_num, 3)
+        for row in db.select('fingerprint', columns=['id', 'key_value_pairs'], include_data=False):
+            equivalence_classes[row.fingerprint] = (row.id, row.times_enumerated)
+    return equivalence_classes
 
-            if fixed_layers:
-                constraint = FixAtoms([a.index for a in struct_to_db if round(a.z, 2) in fixed_layers])
-                struct_to_db.set_constraint(constraint)
-            else:
-                logging.warning('No fixed layers are provided.')
-            if mag_ms:
-                for a in struct_to_db:
-                    if a.tag != 2:
-                        a.magmom = mag_ms[a.symbol]
-            db.write(struct_to_db, top_layer_atom_index=top_layer_atom_index, **cov)
-    logging.info('The structures have been generated and stored in the database.')
+def decorate_chunks(generated_structures, decorate, chunk_size, processes=1):
+    """
+    Consume the enumerated structures in chunks and yield the decorated chunks in the enumeration order.
+    With more than one process, the next chunk is enumerated and decorated by the pool while the previous one is written.
+    generated_structures: generator
+        The structures enumerated by ICET.
+    decorate: callable
+        The function decorating a single structure, must be picklable when processes > 1.
+    chunk_size: int
+        The number of structures in each chunk.
+    processes: int
+        The number of worker processes.
+    """
+    if processes <= 1:
+        while True:
+            structs = list(islice(generated_structures, chunk_size))
+            if not structs:
+                return
+            yield [decorate(struct) for struct in structs]
+    with Pool(processes) as pool:
+        pending = None
+        while True:
+            structs = list(islice(generated_structures, chunk_size))
+            submitted = pool.map_async(decorate, structs, chunksize=max(1, len(structs) // (4 * processes))) if structs else None
+            if pending is not None:
+                yield pending.get()
+            if submitted is None:
+                return
+            pending = submitted
 
-def select_covs(db_path, ads_ranges, structure_num, total_atom_num_constraint=False, output_db='dft_structures.db'):
+def write_chunk(db, chunk, metadata=None, enumeration_counts=None):
+    """
+    Write a chunk of structures to the database in a single transaction and empty the chunk.
+    db: ase.db.core.Database
+        The database to write the structures to.
+    chunk: list
+        A list of (ase.Atoms, dict) tuples, the dict holds the key_value_pairs of the structure.
+    metadata: dict
+        The entries to update in the database metadata, committed in the same transaction as the structures.
+    enumeration_counts: dict, {str: int}
+        The new times_enumerated of the equivalence classes already stored in the database, keyed by fingerprint.
+    Returns:
+        int: the number of structures written.
+    """
+    if not chunk and not enumeration_counts and not metadata:
+        return 0
+    with db:
+        for atoms, key_value_pairs in chunk:
+            db.write(atoms, **key_value_pairs)
+        if enumeration_counts:
+            for fingerprint, times_enumerated in enumeration_counts.items():
+                db.update(db.get(fingerprint=fingerprint).id, times_enumerated=times_enumerated)
+        if metadata:
+            db.metadata = dict(db.metadata, **metadata)
+    written = len(chunk)
+    chunk.clear()
+    return written
+
+def log_throughput(struct_num, start_time):
+    """
+    Log the number of structures stored so far and the throughput in structures per second.
+    struct_num: int
+        The number of structures stored.
+    start_time: float
+        The time.perf_counter() value when the enumeration started.
+    """
+    elapsed = time.perf_counter() - start_time
+    rate = struct_num / elapsed if elapsed > 0 else float('inf')
+    logging.info(f'{struct_num} structures stored in {elapsed:.2f} s ({rate:.1f} structures/s).')
+
+def create_natoms_index(db_path):
+    """
+    Index the number of atoms column of an ASE SQLite database so the structures can be filtered by size in the query.
+    db_path: str
+        The path to the ASE database.
+    """
+    if not db_path.endswith('.db') or not os.path.exists(db_path):
+        return
+    with sqlite3.connect(db_path) as con:
+        con.execute('CREATE INDEX IF NOT EXISTS natoms_index ON systems(natoms)')
+
+def select_covs(db_path, ads_ranges, structure_num, total_atom_num_constraint=False, output_db='dft_structures.db', stratify=False, bins=None, seed=None):
     """
     This function randomly selects a structure from each coverage group and 
     stores the structure's index in a csv file.
@@ -148,37 +469,46 @@ def select_covs(db_path, ads_ranges, structure_num, total_atom_num_constraint=Fa
         The maximum number of atoms in the unit cell, if set, the structures with more atoms will be filtered out.
     output_db: str 
         The output db to store the randomly selected structures.
+    stratify: bool
+        A flag to split the coverage space into bins and sample the same number of structures from each bin,
+        instead of sampling uniformly from all the filtered structures.
+    bins: int or list
+        The number of bins along each adsorbate's coverage range, if None, each coverage combination is its own bin.
+    seed: int
+        The seed of the random number generator, set it to reproduce a selection.
 
     Returns:
         dict: a dictionary contain selected structures
         The dictionary contains the following keys:
             - "coverage" (float): The strcuture's index with the corresponding coverage.
     """
+    query = []
+    for ads in ads_ranges.keys():
+        query.append(f'{ads.lower()}>={ads_ranges[ads][0]}')
+        query.append(f'{ads.lower()}<={ads_ranges[ads][1]}')
+    if total_atom_num_constraint:
+        query.append(f'natoms<={total_atom_num_constraint}')
+    query = ','.join(query)
+    create_natoms_index(db_path)
+    rng = random.Random(seed)
     with connect(db_path) as db:
-        query = []
-        for ads in ads_ranges.keys():
-            query.append(f'{ads.lower()}>={ads_ranges[ads][0]}')
-            query.append(f'{ads.lower()}<={ads_ranges[ads][1]}')
-        query = ','.join(query)
-        filtered_structs = db.select(query)
-        if is_generator_empty(filtered_structs):
+        # only the ids are read to sample, the selected rows are read afterwards
+        if stratify:
+            ranges = [ads_ranges[ads] for ads in ads_ranges.keys()]
+            binned_ids = ((coverage_bin([row.key_value_pairs[ads.lower()] for ads in ads_ranges.keys()], ranges, bins), row.id)
+                          for row in db.select(query, columns=['id', 'key_value_pairs'], include_data=False))
+            random_samples, quotas = stratified_sample(binned_ids, structure_num, rng)
+            filtered_num = len(quotas)
+            logging.info(f'{len(random_samples)} structures are sampled from {len(quotas)} coverage bins.')
+        else:
+            filtered_ids = (row.id for row in db.select(query, columns=['id'], include_data=False))
+            random_samples, filtered_num = reservoir_sample(filtered_ids, structure_num, rng)
+        if filtered_num == 0:
             raise NoStructureMatchQueryError('No structure matches to your query in the database.')
-        filtered_structures = []
-        for struct in filtered_structs:
-            if total_atom_num_constraint:
-                if len(struct.toatoms()) > total_atom_num_constraint:
-                    continue
-                filtered_structures.append(struct)
-            else:
-                filtered_structures.append(struct)
-    random_sample_size = min(structure_num, len(filtered_structures))
-    if random_sample_size != structure_num:
-        logging.warning(f'The number of structures to randomly select is greater than the number of structures matches to your query. Randomly selecting {random_samples} structures.')
-    random_samples = random.sample(range(len(filtered_structures)), random_sample_size)
-    samples_pool = []
+        if len(random_samples) != structure_num:
+            logging.warning(f'The number of structures to randomly select is greater than the number of structures matches to your query. Randomly selecting {len(random_samples)} structures.')
+        samples_pool = [db.get(id=i) for i in random_samples]
     sample_ids = []
-    for i in random_samples:
-        samples_pool.append(filtered_structures[i])
     with connect(output_db) as dbout:
         for struct in samples_pool:
             logging.info(f'{struct.key_value_pairs}, the structure id is{struct.id}')
@@ -0,0 +1,164 @@
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+
+class LowerConvexHull:
+    """
+    The lower convex hull of the energies over the coverage space of any number of adsorbates.
+    The hull is built from the lowest energy at each coverage, and only the hull vertices are kept,
+    since a point above the hull can not become a vertex when more points are added.
+    So the hull is updated with new results without the points seen before.
+    """
+    def __init__(self, coverages=None, energies=None, ids=None, tol=1e-8):
+        """
+        coverages: numpy.ndarray
+            The (n, number of adsorbates) coverages of the structures.
+        energies: numpy.ndarray
+            The n energies, normalized the same way for all the structures, e.g. per surface unit cell.
+        ids: numpy.ndarray
+            The n ids of the structures, e.g. their ids in the database, by default their indices.
+        tol: float
+            The tolerance of the geometric tests.
+        """
+        self.tol = tol
+        self.coverages = None
+        self.energies = np.empty(0)
+        self.ids = np.empty(0, dtype=int)
+        if coverages is not None:
+            self.update(coverages, energies, ids)
+
+    def update(self, coverages, energies, ids=None):
+        """
+        Add structures to the hull.
+        coverages: numpy.ndarray
+            The (n, number of adsorbates) coverages of the new structures.
+        energies: numpy.ndarray
+            The n energies of the new structures.
+        ids: numpy.ndarray
+            The n ids of the new structures, by default their indices.
+        Returns:
+            bool: True if the hull changed.
+        """
+        coverages = np.atleast_2d(np.asarray(coverages, dtype=float))
+        energies = np.asarray(energies, dtype=float).reshape(-1)
+        ids = np.arange(len(energies)) if ids is None else np.asarray(ids).reshape(-1)
+        if self.coverages is not None:
+            # the new structures on or above the hull can not change it
+            below = ~(self.energy_above_hull(coverages, energies) >= -self.tol)
+            if not below.any():
+                return False
+            coverages = np.concatenate([self.coverages, coverages[below]])
+            energies = np.concatenate([self.energies, energies[below]])
+            ids = np.concatenate([self.ids, ids[below]])
+        coverages, energies, ids = coverage_minima(coverages, energies, ids)
+        self.build(coverages, energies, ids)
+        return True
+
+    def build(self, coverages, energies, ids):
+        """
+        Build the hull from the lowest energy at each coverage, coverages must be unique.
+        The coverages are projected onto the affine subspace they span, so a fixed coverage of one adsorbate is allowed.
+        """
+        self.origin = coverages.mean(axis=0)
+        _, s, vt = np.linalg.svd(coverages - self.origin, full_matrices=False)
+        self.basis = vt[s > self.tol * max(1.0, s.max(initial=0.0))]
+        x = self.project(coverages)
+        dim = len(self.basis)
+        if dim == 0:
+            vertices = np.array([0])
+            # no slope columns, the projected coverages have no dimension
+            self.planes = np.array([[energies[0]]])
+            self.domain = np.empty((0, 1))
+        elif dim == 1:
+            vertices = lower_chain(x[:, 0], energies, self.tol)
+            xv, ev = x[vertices, 0], energies[vertices]
+            slopes = np.diff(ev) / np.diff(xv)
+            self.planes = np.column_stack([slopes, ev[:-1] - slopes * xv[:-1]]) if len(vertices) > 1 else np.array([[0.0, ev[0]]])
+            self.domain = np.array([[-1.0, xv.min()], [1.0, -xv.max()]])
+        else:
+            self.domain = ConvexHull(x).equations
+            try:
+                hull = ConvexHull(np.column_stack([x, energies]))
+            except QhullError:
+                # all the points are on one plane
+                a = np.linalg.lstsq(np.column_stack([x, np.ones(len(x))]), energies, rcond=None)[0]
+                vertices = np.arange(len(x))
+                self.planes = a.reshape(1, -1)
+            else:
+                lower = hull.equations[:, -2] < -self.tol
+                normals = hull.equations[lower]
+                # n_x . x + n_e * e + c = 0 for the points on a facet, so e = -(n_x . x + c) / n_e
+                self.planes = np.column_stack([normals[:, :-2], normals[:, -1:]]) / -normals[:, -2:-1]
+                vertices = np.unique(hull.simplices[lower])
+        self.coverages = coverages[vertices]
+        self.energies = energies[vertices]
+        self.ids = ids[vertices]
+
+    def project(self, coverages):
+        return (np.atleast_2d(coverages) - self.origin) @ self.basis.T
+
+    def hull_energy(self, coverages, chunk_size=100000):
+        """
+        Get the energy of the hull at the coverages.
+        coverages: numpy.ndarray
+            The (n, number of adsorbates) coverages.
+        chunk_size: int
+            The number of coverages evaluated at a time, to bound the memory.
+        Returns:
+            numpy.ndarray: the n hull energies, nan outside the coverages spanned by the hull.
+        """
+        coverages = np.atleast_2d(np.asarray(coverages, dtype=float))
+        result = np.empty(len(coverages))
+        for start in range(0, len(coverages), chunk_size):
+            c = coverages[start:start + chunk_size]
+            x = self.project(c)
+            # the lower hull is convex, so it is the highest of the planes of its facets
+            e = (x @ self.planes[:, :-1].T + self.planes[:, -1]).max(axis=1)
+            outside = np.linalg.norm(c - self.origin - x @ self.basis, axis=1) > self.tol
+            if len(self.domain):
+                outside |= (x @ self.domain[:, :-1].T + self.domain[:, -1]).max(axis=1) > self.tol
+            e[outside] = np.nan
+            result[start:start + chunk_size] = e
+        return result
+
+    def energy_above_hull(self, coverages, energies):
+        """
+        Get the energy above the hull of the structures, 0 for the hull vertices.
+        coverages: numpy.ndarray
+            The (n, number of adsorbates) coverages of the structures.
+        energies: numpy.ndarray
+            The n energies of the structures.
+        Returns:
+            numpy.ndarray: the n energies above the hull, nan outside the coverages spanned by the hull.
+        """
+        return np.asarray(energies, dtype=float).reshape(-1) - self.hull_energy(coverages)
+
+def coverage_minima(coverages, energies, ids):
+    """
+    Keep the structure with the lowest energy at each coverage, the first one among equal energies.
+    Returns:
+        tuple: (numpy.ndarray, numpy.ndarray, numpy.ndarray), the unique coverages, their lowest energies and the ids.
+    """
+    # sort by coverage then energy, the stable sort keeps the lowest index first among equal energies
+    order = np.lexsort((energies,) + tuple(coverages.T[::-1]))
+    sorted_covs = coverages[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (sorted_covs[1:] != sorted_covs[:-1]).any(axis=1)
+    return sorted_covs[first], energies[order[first]], ids[order[first]]
+
+def lower_chain(x, energies, tol=1e-8):
+    """
+    Get the vertices of the lower hull of points on a line with the monotone chain algorithm, x must be unique.
+    Returns:
+        numpy.ndarray: the indices of the vertices in ascending x.
+    """
+    chain = []
+    for i in np.argsort(x):
+        while len(chain) >= 2:
+            a, b = chain[-2], chain[-1]
+            # drop b if it is on or above the segment from a to i
+            if (x[b] - x[a]) * (energies[i] - energies[a]) - (energies[b] - energies[a]) * (x[i] - x[a]) <= tol:
+                chain.pop()
+            else:
+                break
+        chain.append(i)
+    return np.array(chain)
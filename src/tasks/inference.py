@@ -1,20 +1,46 @@
-import os, random
-from fairchem.core.common.relaxation.ase_utils import OCPCalculator
+import os, random, time, sqlite3
+from contextlib import nullcontext
+from multiprocessing import Pool
 from functools import wraps
 from ase.optimize import BFGS
 from ase.db import connect
+from ase.db.core import now
+from ase.db.row import AtomsRow, atoms2dict
+from ase.calculators.calculator import all_properties
 import matplotlib.pyplot as plt
-from sklearn.metrics import mean_squared_error 
 import numpy as np
 from ase.io.trajectory import Trajectory
-from caxpert.src.utils.utils import timeit
+from ase.data import atomic_numbers
+from caxpert.src.utils.utils import timeit, stratified_sample, coverage_bin
+from caxpert.src.tasks.relax import BatchRelaxer, OCPBatchCalculator, ResultStore, get_optimizer, validate_batches
+from caxpert.src.tasks.hull import LowerConvexHull
+from caxpert.src.utils.work_queue import WorkQueue
 import plotly.express as px
 import pandas as pd
 
 
-def ml_validate(checkpoint_path, database_path, trainer='equiformerv2_forces', fig_path='parity_plot.png'):
+# the calculators loaded in this process, keyed by (checkpoint_path, trainer)
+calculator_pool = dict()
+
+def get_calculator(checkpoint_path, trainer='equiformerv2_forces'):
+    """
+    Get the OCPCalculator of a checkpoint, the checkpoint is loaded once per process and the calculator is reused afterwards.
+    checkpoint_path: str
+        The path to the checkpoint file.
+    trainer: str
+        The trainer to pass to the OCPCalculator.
+    """
+    from fairchem.core.common.relaxation.ase_utils import OCPCalculator
+    key = (checkpoint_path, trainer)
+    if key not in calculator_pool:
+        calculator_pool[key] = OCPCalculator(checkpoint_path=checkpoint_path, trainer=trainer)
+    return calculator_pool[key]
+
+def ml_validate(checkpoint_path, database_path, trainer='equiformerv2_forces', fig_path='parity_plot.png', batch_size=32, errors_path=None,
+                plot_points=10000, return_metrics=False):
     """
     Validate the ML model using the test set.
+    The structures are streamed from the database and evaluated in batches, so the memory does not grow with the test set.
     checkpoint_path: str
         The path to the checkpoint file.
     database_path: str
@@ -23,20 +49,25 @@ def ml_validate(checkpoint_path, database_path, trainer='equiformerv2_forces', f
         The trainer to pass to the OCPCalculator.
     fig_path: str
         The path to save the parity plot.
+    batch_size: int
+        The number of structures evaluated with one model call.
+    errors_path: str
+        The path to write the errors of each structure, see validate_batches, not written if None.
+    plot_points: int
+        The maximum number of structures in the parity plot, randomly sampled, None to plot all of them.
+    return_metrics: bool
+        A flag to return the dict of all the metrics instead of the energy and fmax MSEs.
+    Returns:
+        tuple: (float, float), the energy MSE and the MSE of the maximum force of each structure,
+        or with return_metrics, dict: the number of structures, the energy MAE and RMSE, the per-component force MAE and RMSE and the fmax MSE.
     """
-    calc = OCPCalculator(checkpoint_path=checkpoint_path, trainer=trainer)
-    db = connect(database_path)
-    trajs = []
-    for row in db.select():
-        trajs.append(row.toatoms())
-    traj_e_dfts = [traj.get_potential_energy() for traj in trajs]
-    fmax_e_dfts = [np.max(np.linalg.norm(traj.get_forces(), axis=1)) for traj in trajs]
-    traj_e_ocps = []
-    fmax_e_ocps = []
-    for traj in trajs:
-        traj.calc = calc
-        traj_e_ocps.append(traj.get_potential_energy())
-        fmax_e_ocps.append(np.max(np.linalg.norm(traj.get_forces(), axis=1)))
+    calc = get_calculator(checkpoint_path, trainer)
+    with connect(database_path) as db:
+        structures = ((row.id, row.toatoms()) for row in db.select())
+        metrics, traj_e_dfts, traj_e_ocps = validate_batches(structures, OCPBatchCalculator(calc), batch_size, errors_path,
+                                                             plot_points=plot_points, rng=random.Random(0))
+    for k, v in metrics.items():
+        print(f'{k}: {v}')
     plt.figure(figsize=(6, 6))
     plt.scatter(traj_e_dfts, traj_e_ocps, color='b', marker='o', label='ML predictions')
     plt.plot([min(traj_e_dfts), max(traj_e_dfts)], [min(traj_e_ocps), max(traj_e_ocps)], color='r', linestyle='--')
@@ -46,10 +77,12 @@ def ml_validate(checkpoint_path, database_path, trainer='equiformerv2_forces', f
     plt.legend()
     plt.grid(True)
     plt.savefig(fig_path)
-    return mean_squared_error(traj_e_dfts, traj_e_ocps, squared=True), mean_squared_error(fmax_e_dfts, fmax_e_ocps, squared=True)
+    if return_metrics:
+        return metrics
+    return metrics['energy_rmse'] ** 2, metrics['fmax_mse']
 
 @timeit
-def ml_relax_db(input_db, checkpoint_path, start_id, output_path='', interval=1000, log_file='-', fmax=0.03, steps=300, trainer='equiformerv2_forces'):
+def ml_relax_db(input_db, checkpoint_path, start_id, output_path='', interval=1000, log_file='-', fmax=0.03, steps=300, trainer='equiformerv2_forces', warmup=False, batch_size=1, optimizer='BFGS', optimizer_kwargs=None):
     """
     Relax the structures in the database using the ML model.
     This function is designed to be used with SLURM job arrays.
@@ -61,7 +94,8 @@ def ml_relax_db(input_db, checkpoint_path, start_id, output_path='', interval=10
     start_id: int
         The ID of the first structure to relax.
     output_path: str
-        The path to save the relaxed structures.
+        The path to save the relaxed structures, the final frames are written to ml_inf_{START ID}_to_{STOP ID}.traj
+        and the records of the relaxations to ml_inf_{START ID}_to_{STOP ID}.rec, see ResultStore.
     interval: int
         The number of structures to relax in each job.
     log_file: str
@@ -72,26 +106,175 @@ def ml_relax_db(input_db, checkpoint_path, start_id, output_path='', interval=10
         The number of steps for the relaxation.
     trainer: str
         The trainer to pass to the OCPCalculator.
+    warmup: bool
+        A flag to run a single point calculation on the first structure before relaxing,
+        so the one-off model initialization is not counted in the relaxation time.
+    batch_size: int
+        The number of structures relaxed together with one model call per step, 1 relaxes the structures one at a time.
+        The relaxed structures are written in the same order in both cases.
+    optimizer: str
+        The optimizer, one of "BFGS", "FIRE", "LBFGS" or "PreconLBFGS" (not with batch_size > 1).
+    optimizer_kwargs: dict
+        The keyword arguments passed to the optimizer, e.g. {'memory': 20} for LBFGS.
     """
     start_id = int(start_id)
     stop_id = start_id + interval
-    output_traj = os.path.join(output_path, f'ml_inf_{start_id}_to_{stop_id}.traj')
-    if os.path.exists(output_traj):
-        start_id = int(start_id) + len(Trajectory(output_traj)) - 1 
-
+    store = ResultStore(os.path.join(output_path, f'ml_inf_{start_id}_to_{stop_id}'))
+    # the ids with a record are done, the restarted tasks skip exactly them whatever the gaps in the ids
+    done_ids = store.done_ids()
     query = f'id>={start_id},id<{stop_id}'
-    with connect(input_db) as db:
-        for row in db.select(query):
-            adslab = row.toatoms()
-            with Trajectory(output_traj, 'a') as traj:
-                calc = OCPCalculator(checkpoint_path=checkpoint_path, trainer=trainer)   
-                adslab.calc = calc
-                opt_slab = BFGS(adslab, logfile=log_file)
-                opt_slab.run(fmax=fmax, steps=steps)
-                traj.write(adslab)
+    with connect(input_db) as db, store:
+        calc, timings = load_calculator(checkpoint_path, trainer, db if warmup else None, query)
+        opt = get_optimizer(optimizer, **(optimizer_kwargs or dict()))
+        rows = (row for row in db.select(query) if row.id not in done_ids)
+        struct_num = relax_to_store(rows, calc, store, timings, fmax, steps, log_file, batch_size, opt)
+    print_timings(timings, struct_num)
     print('Done!')
 
-def mk_inf_db(input_db, trajs_path, output_db):
+@timeit
+def ml_relax_queue(input_db, checkpoint_path, queue_db, worker, output_path='', claim_size=16, reclaim_after=None, log_file='-', fmax=0.03, steps=300, trainer='equiformerv2_forces', warmup=False, batch_size=1, optimizer='BFGS', optimizer_kwargs=None):
+    """
+    Relax the structures in the database using the ML model, taking the ids from a shared work queue instead of fixed intervals.
+    Any number of workers, e.g. the tasks of a SLURM job array or local processes, can run this function with the same queue,
+    they claim claim_size ids at a time until the queue is drained, so the workers with small or fast structures take more ids.
+    Fill the queue once before starting the workers, e.g. WorkQueue(queue_db).add(row.id for row in db.select(columns=['id'])).
+    input_db: str
+        The path to the database with the structures to relax.
+    checkpoint_path: str
+        The path to the checkpoint file.
+    queue_db: str
+        The path to the SQLite file of the WorkQueue.
+    worker: int
+        The number of the worker, e.g. the SLURM array task id. The results are written to ml_inf_{WORKER}_worker.traj and .rec,
+        and a worker restarting with the same number first puts the ids it claimed before back into the queue.
+    output_path: str
+        The path to save the relaxed structures.
+    claim_size: int
+        The number of ids claimed at a time, use at least batch_size.
+    reclaim_after: float
+        If set, the ids claimed by any worker more than reclaim_after seconds ago are put back into the queue at the start,
+        set it longer than the time to relax claim_size structures.
+    The other arguments are the same as in ml_relax_db.
+    """
+    queue = WorkQueue(queue_db)
+    queue.reclaim(worker=worker)
+    if reclaim_after is not None:
+        queue.reclaim(timeout=reclaim_after)
+    store = ResultStore(os.path.join(output_path, f'ml_inf_{worker}_worker'))
+    done_ids = store.done_ids()
+    with connect(input_db) as db, store:
+        calc, timings = load_calculator(checkpoint_path, trainer, db if warmup else None)
+        opt = get_optimizer(optimizer, **(optimizer_kwargs or dict()))
+        rows = claim_rows(db, queue, worker, claim_size, done_ids)
+        struct_num = relax_to_store(rows, calc, store, timings, fmax, steps, log_file, batch_size, opt, queue)
+    print_timings(timings, struct_num)
+    print(f'Done! {queue.counts()}')
+
+def load_calculator(checkpoint_path, trainer, warmup_db=None, warmup_query=None):
+    """
+    Load the calculator of the relaxations and time it as the "load" stage of the timings.
+    warmup_db: ase.db.core.Database
+        If set, a single point calculation is run on the first row of warmup_query,
+        so the one-off model initialization is counted in the load time rather than in the relaxation time.
+    warmup_query: str
+        The ase.db query of the warmup row, all the rows by default.
+    Returns:
+        tuple: (ase.calculators.calculator.Calculator, dict), the calculator and the timings of the relaxation stages.
+    """
+    timings = {'load': 0.0, 'relax': 0.0, 'write': 0.0}
+    start_time = time.perf_counter()
+    calc = get_calculator(checkpoint_path, trainer)
+    if warmup_db is not None:
+        for row in warmup_db.select(warmup_query, limit=1):
+            warmup_slab = row.toatoms()
+            warmup_slab.calc = calc
+            warmup_slab.get_potential_energy()
+    timings['load'] += time.perf_counter() - start_time
+    return calc, timings
+
+def claim_rows(db, queue, worker, claim_size, done_ids):
+    """
+    Claim the ids from the queue and yield their rows until the queue is drained.
+    The claimed ids already in done_ids are marked as done without yielding them.
+    """
+    while True:
+        ids = queue.claim(worker, claim_size)
+        if not ids:
+            return
+        queue.complete([i for i in ids if i in done_ids])
+        for i in ids:
+            if i not in done_ids:
+                yield db.get(id=i)
+
+def relax_to_store(rows, calc, store, timings, fmax, steps, log_file, batch_size, optimizer, queue=None):
+    """
+    Relax the rows and append the results to the store, the time of each stage is added to timings.
+    The name of the calculator is recorded in the store, see ResultStore.
+    If a queue is passed, each id is marked as done once its result is stored.
+    Returns:
+        int: the number of relaxed structures.
+    """
+    store.calculator_name = calc.name
+    if batch_size > 1:
+        relaxer = BatchRelaxer(OCPBatchCalculator(calc), batch_size=batch_size, fmax=fmax, steps=steps, optimizer=optimizer)
+        relaxed = relaxer.run((row.id, row.toatoms()) for row in rows)
+    else:
+        relaxed = relax_one_by_one(rows, calc, fmax, steps, log_file, optimizer)
+    struct_num = 0
+    start_time = time.perf_counter()
+    for source_id, adslab, result in relaxed:
+        timings['relax'] += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        store.append(source_id, adslab, result)
+        if queue is not None:
+            queue.complete([source_id])
+        timings['write'] += time.perf_counter() - start_time
+        struct_num += 1
+        start_time = time.perf_counter()
+    return struct_num
+
+def relax_one_by_one(rows, calc, fmax, steps, log_file='-', optimizer=BFGS):
+    """
+    Relax the structures one at a time.
+    rows: iterable of ase.db.row.AtomsRow
+        The rows of the structures to relax.
+    calc: ase.calculators.calculator.Calculator
+        The calculator shared by all the structures.
+    fmax: float
+        The maximum force for the relaxation.
+    steps: int
+        The maximum number of steps for the relaxation.
+    log_file: str
+        The path to log the relax history.
+    optimizer: callable
+        The optimizer class, see get_optimizer.
+    Yields:
+        tuple: (int, ase.Atoms, dict), the row id, the relaxed structure and a dictionary with the keys "energy", "fmax", "steps" and "converged".
+    """
+    for row in rows:
+        adslab = row.toatoms()
+        adslab.calc = calc
+        opt_slab = optimizer(adslab, logfile=log_file)
+        converged = opt_slab.run(fmax=fmax, steps=steps)
+        forces = adslab.get_forces()
+        result = {'energy': adslab.get_potential_energy(), 'fmax': float(np.sqrt((forces ** 2).sum(axis=1).max())),
+                  'steps': opt_slab.nsteps, 'converged': bool(converged)}
+        yield row.id, adslab, result
+
+def print_timings(timings, struct_num):
+    """
+    Print the time spent in each stage of the relaxations.
+    timings: dict
+        The time in seconds spent in each stage.
+    struct_num: int
+        The number of structures relaxed.
+    """
+    for stage, total_time in timings.items():
+        per_struct = total_time / struct_num if struct_num else 0.0
+        print(f'{stage}: {total_time:.2f} s in total, {per_struct:.3f} s per structure over {struct_num} structures')
+
+@timeit
+def mk_inf_db(input_db, trajs_path, output_db, chunk_size=1000, processes=1):
     """
     This function writes the ML relaxed structures to a database.
     It reads the extra key_value_pairs from the original input_db
@@ -102,29 +285,124 @@ def mk_inf_db(input_db, trajs_path, output_db):
         The path to the directory with the relaxed structures written in .traj format.
         if a str is passed, the files must be written as 'ml_inf_{START ID}_to_{STOP ID}.traj'.
         if a list is passed, the files must be in the order to match the structures' order in the input_db.
+        If a .traj file has its .rec file written by ml_relax_db next to it, the structures are matched by the source ids
+        in the records and the records are written as the key_value_pairs source_id, relax_steps and converged.
+        Each source id is written once: within a file the last record wins if it was relaxed more than once,
+        across files the first file in order wins, and the source ids already in the output_db are skipped,
+        so the function can be run again as more results come in without duplicating rows.
     output_db: str
         The path to the output database.
+    chunk_size: int
+        The number of structures written to the output_db in each transaction.
+    processes: int
+        The number of processes reading the .traj files concurrently, the output_db is written by this process only.
     """
     if type(trajs_path) == list:
         trajs = trajs_path
     else:
-        traj_ps = [i for i in os.listdir(trajs_path) if 'ml_inf' in i]
+        traj_ps = [i for i in os.listdir(trajs_path) if 'ml_inf' in i and i.endswith('.traj')]
         traj_ps = sorted(traj_ps, key=lambda x:int(x.split('_')[2]))
         trajs = [os.path.join(trajs_path, t) for t in traj_ps]
     if not os.path.exists(input_db):
         raise FileNotFoundError(f'{input_db} does not exist!')
+    with connect(input_db) as db:
+        key_value_pairs = {row.id: row.key_value_pairs for row in db.select(columns=['id', 'key_value_pairs'], include_data=False)}
+    odb = connect(output_db)
+    with odb:
+        written_ids = set(row.source_id for row in odb.select('source_id', columns=['id', 'key_value_pairs']))
     str_id = 0
-    with connect(input_db) as db, connect(output_db) as odb:
-        for t in trajs:
-            atoms = Trajectory(t)
-            for a in atoms:
-                str_id += 1
-                key_value_pairs = db.get(id=str_id).key_value_pairs
-                odb.write(a, key_value_pairs=key_value_pairs)
+    chunk = []
+    with Pool(processes) if processes > 1 else nullcontext() as pool:
+        results = pool.imap(read_relaxed, trajs) if pool is not None else map(read_relaxed, trajs)
+        for relaxed in results:
+            for source_id, row, extra in relaxed:
+                if source_id is None:
+                    str_id += 1
+                    chunk.append((row, key_value_pairs[str_id]))
+                elif source_id not in written_ids:
+                    written_ids.add(source_id)
+                    chunk.append((row, dict(key_value_pairs[source_id], **extra)))
+                if len(chunk) >= chunk_size:
+                    write_relaxed(odb, chunk)
+                    chunk = []
+    write_relaxed(odb, chunk)
     print('Done!')
 
+def read_relaxed(traj_path):
+    """
+    Read the relaxed structures of a .traj file written by ml_relax_db as database rows.
+    The rows are converted here, so the conversion runs in the reading processes and the writing process only inserts them.
+    traj_path: str
+        The path to the .traj file.
+    Returns:
+        list: (int, ase.db.row.AtomsRow, dict), the source id, the structure and the key_value_pairs of its record.
+        The source id is None and the dictionary is empty for a .traj file without its .rec file.
+    """
+    traj = Trajectory(traj_path)
+    store = ResultStore(os.path.splitext(traj_path)[0])
+    if not os.path.exists(store.records_path):
+        return [(None, atoms_to_row(atoms), dict()) for atoms in traj]
+    records = {int(record['source_id']): record for record in store.read_records()}
+    return [(source_id, atoms_to_row(traj[int(record['frame'])]),
+             dict(source_id=source_id, relax_steps=int(record['steps']), converged=bool(record['converged'])))
+            for source_id, record in records.items()]
+
+def atoms_to_row(atoms):
+    """
+    Convert a structure to the row written by ase.db, with the creation time and user set as db.write(atoms) does.
+    The calculator results of a frame read from a trajectory always match its structure,
+    so they are copied without the comparison of the structures that makes AtomsRow(atoms) slow.
+    """
+    calc = atoms.calc
+    atoms.calc = None
+    dct = atoms2dict(atoms)
+    if calc is not None:
+        dct['calculator'] = calc.name.lower()
+        dct['calculator_parameters'] = calc.todict()
+        dct.update((k, v) for k, v in calc.results.items() if k in all_properties)
+    row = AtomsRow(dct)
+    row.ctime = now()
+    row.user = os.getenv('USER')
+    return row
+
+def write_relaxed(odb, chunk):
+    """
+    Write a chunk of relaxed structures in one transaction.
+    odb: ase.db.core.Database
+        The output database.
+    chunk: list
+        The (ase.db.row.AtomsRow, dict) structures and their key_value_pairs.
+    """
+    with odb:
+        for row, key_value_pairs in chunk:
+            odb.write(row, key_value_pairs=key_value_pairs)
+
+def is_sqlite_file(db_path):
+    """
+    Check if an ase.db name is an SQLite file, which starts with the SQLite header.
+    """
+    if not os.path.isfile(db_path):
+        return False
+    with open(db_path, 'rb') as f:
+        return f.read(16) == b'SQLite format 3\x00'
+
+def first_coverage_minima(coverages, energies, ids):
+    """
+    Keep the structure with the lowest energy at each coverage, the first one among equal energies,
+    with the coverages in the order they first appear.
+    Returns:
+        tuple: (numpy.ndarray, numpy.ndarray, numpy.ndarray), the unique coverages, their lowest energies and the ids.
+    """
+    covs, inverse = np.unique(coverages, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # sort by coverage then energy, the stable sort keeps the lowest id first among equal energies
+    order = np.lexsort((energies, inverse))
+    first = order[np.unique(inverse[order], return_index=True)[1]]
+    appearance = np.argsort(np.unique(inverse, return_index=True)[1], kind='stable')
+    return covs[appearance], energies[first[appearance]], ids[first[appearance]]
+
 class MLInfDataProcess:
-    def __init__(self, input_db, adsorbate_names, metal_atom, unit_cell_metal_atom_num):
+    def __init__(self, input_db, adsorbate_names, metal_atom, unit_cell_metal_atom_num, cache_path=None):
         """
         This class is designed to process the data for ML inference.
         input_db: str
@@ -135,11 +413,17 @@ class MLInfDataProcess:
             The name of the metal atom.
         unit_cell_metal_atom_num: int
             The number of metal atoms in the unit cell.
+        cache_path: str
+            The path to the .npz file caching the lowest energy at each coverage, by default {INPUT DB NAME}_minima.npz.
+            The cache is updated from the new rows when rows are added to the database and rebuilt when rows are changed or deleted.
+            Set it to False to only cache in memory.
         """
         self.input_db = input_db
         self.adsorbate_names = adsorbate_names
         self.metal_atom = metal_atom
         self.unit_cell_metal_atom_num = unit_cell_metal_atom_num
+        self.cache_path = os.path.splitext(input_db)[0] + '_minima.npz' if cache_path is None else cache_path
+        self.minima = None
     def plot_energy(self, output_fig=None):
         """
         Plot the energy of the structures in the database. This function is not designed to work with alloys.
@@ -148,15 +432,9 @@ class MLInfDataProcess:
         """
         if len(self.adsorbate_names) > 2:
             raise ValueError('System with adsorbate number more than 2 is not supported now!')
-        energies = []
-        coverages = []
-        with connect(self.input_db) as db:
-            for row in db.select():
-                energy = row.toatoms().get_potential_energy()
-                covs = [row.key_value_pairs[n] for n in self.adsorbate_names]
-                sites = row.toatoms().get_chemical_symbols().count(self.metal_atom)/self.unit_cell_metal_atom_num
-                energies.append(energy/sites)
-                coverages.append(covs)
+        columns = self.read_columns()
+        energies = columns['energy'] / columns['sites']
+        coverages = columns['coverages'].tolist()
         if len(coverages[0]) == 1:
             coverages = [i for i in coverages]
             plt.scatter(coverages, energies)
@@ -177,24 +455,124 @@ class MLInfDataProcess:
                 fig.write_html(output_fig)
             else:
                 fig.show()
-    def get_convex_hull(self):
-        structs = dict()
+    def read_columns(self, query=None):
+        """
+        Read the columns used by the analyses in one pass over the database.
+        Only the id, energy, atomic numbers and key_value_pairs columns are read, the positions and forces are not decoded.
+        query: str
+            The ase.db query of the rows to read, e.g. "id>1000", all the rows by default.
+        Returns:
+            dict: numpy arrays with the keys "id", "energy", "natoms", "metal_atom_num",
+            "sites" (the number of unit cells of the surface) and "coverages" (shape (n, number of adsorbates)).
+        """
+        ids = []
+        energies = []
+        natoms = []
+        metal_atom_nums = []
+        coverages = []
+        metal_number = atomic_numbers[self.metal_atom]
         with connect(self.input_db) as db:
-            for row in db.select():
-                covs = tuple([row.key_value_pairs[n] for n in self.adsorbate_names])
-                sites = row.toatoms().get_chemical_symbols().count(self.metal_atom)/self.unit_cell_metal_atom_num
-                energy = row.toatoms().get_potential_energy() / sites
-                index = row.id
-                if not covs in structs:
-                    structs[covs] = [(energy,index)]
-                else:
-                    structs[covs].append((energy, index))
+            for row in db.select(query, columns=['id', 'energy', 'natoms', 'numbers', 'key_value_pairs'], include_data=False):
+                ids.append(row.id)
+                energies.append(row.energy)
+                natoms.append(row.natoms)
+                metal_atom_nums.append(np.count_nonzero(row.numbers == metal_number))
+                coverages.append([row.key_value_pairs[n] for n in self.adsorbate_names])
+        metal_atom_nums = np.array(metal_atom_nums, dtype=int)
+        return {'id': np.array(ids, dtype=int), 'energy': np.array(energies, dtype=float), 'natoms': np.array(natoms, dtype=int),
+                'metal_atom_num': metal_atom_nums, 'sites': metal_atom_nums / self.unit_cell_metal_atom_num,
+                'coverages': np.array(coverages, dtype=float).reshape(len(ids), len(self.adsorbate_names))}
+    def get_convex_hull(self):
+        """
+        Get the structure with the lowest energy per unit cell at each coverage.
+        Returns:
+            dict: {tuple: (float, int)}, the coverages of the adsorbates and the energy per unit cell and id of the structure.
+        """
+        minima = self.get_coverage_minima()
         hulls = dict()
-        for k in structs.keys():
-            energies = [e[0] for e in structs[k]]
-            indices_in_db = [e[1] for e in structs[k]]
-            hulls[k] = (min(energies), indices_in_db[np.argmin(energies)])
+        for cov, energy, index in zip(minima['coverages'].tolist(), minima['energies'].tolist(), minima['ids'].tolist()):
+            hulls[tuple(cov)] = (energy, index)
         return hulls
+    def get_coverage_minima(self):
+        """
+        Get the lowest energy per unit cell at each coverage, from the cache if the database did not change since it was written.
+        Only the new rows are read if rows were only added, the whole database is read if rows were changed or deleted.
+        The changes are only detected in an SQLite database, the other backends of ase.db, e.g. .json or PostgreSQL, are read in full every time.
+        Returns:
+            dict: numpy arrays with the keys "coverages", "energies" and "ids", the coverages are in the order they first appear.
+        """
+        if not is_sqlite_file(self.input_db):
+            columns = self.read_columns()
+            coverages, energies, ids = first_coverage_minima(columns['coverages'], columns['energy'] / columns['sites'], columns['id'])
+            return {'coverages': coverages.reshape(len(ids), len(self.adsorbate_names)), 'energies': energies, 'ids': ids}
+        stat = os.stat(self.input_db)
+        file_state = np.array([stat.st_mtime_ns, stat.st_size])
+        settings = np.array(self.adsorbate_names + [self.metal_atom, str(self.unit_cell_metal_atom_num)])
+        minima = self.minima
+        if minima is None and self.cache_path and os.path.exists(self.cache_path):
+            with np.load(self.cache_path) as f:
+                minima = dict(f)
+        if minima is not None and not np.array_equal(minima['settings'], settings):
+            minima = None
+        if minima is not None and np.array_equal(minima['file_state'], file_state):
+            self.minima = minima
+            return minima
+        con = sqlite3.connect(self.input_db)
+        try:
+            count, max_mtime, max_id = con.execute('SELECT COUNT(*), MAX(mtime), MAX(id) FROM systems').fetchone()
+            if minima is not None:
+                # the cached rows are unchanged if their number and latest modification time are the same
+                old = con.execute('SELECT COUNT(*), MAX(mtime) FROM systems WHERE id <= ?', (int(minima['max_id']),)).fetchone()
+                if not np.array_equal(np.array(old, dtype=float), minima['revision']):
+                    minima = None
+        finally:
+            con.close()
+        if minima is None:
+            columns = self.read_columns()
+            coverages, energies, ids = first_coverage_minima(columns['coverages'], columns['energy'] / columns['sites'], columns['id'])
+        else:
+            columns = self.read_columns(f'id>{int(minima["max_id"])}')
+            new_coverages, new_energies, new_ids = first_coverage_minima(columns['coverages'], columns['energy'] / columns['sites'], columns['id'])
+            coverages, energies, ids = minima['coverages'], minima['energies'].copy(), minima['ids'].copy()
+            index = {tuple(cov): i for i, cov in enumerate(coverages.tolist())}
+            added = []
+            for i, cov in enumerate(new_coverages.tolist()):
+                j = index.get(tuple(cov))
+                if j is None:
+                    added.append(i)
+                elif new_energies[i] < energies[j]:
+                    energies[j] = new_energies[i]
+                    ids[j] = new_ids[i]
+            coverages = np.concatenate([coverages, new_coverages[added]])
+            energies = np.concatenate([energies, new_energies[added]])
+            ids = np.concatenate([ids, new_ids[added]])
+        self.minima = {'coverages': coverages.reshape(len(ids), len(self.adsorbate_names)), 'energies': energies, 'ids': ids,
+                       'max_id': np.array(max_id or 0), 'revision': np.array([count, max_mtime], dtype=float),
+                       'file_state': file_state, 'settings': settings}
+        if self.cache_path:
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **self.minima)
+            os.replace(tmp_path, self.cache_path)
+        return self.minima
+    def get_lower_hull(self, energy_above_hull=True):
+        """
+        Build the lower convex hull of the energies per unit cell over the coverages of the adsorbates.
+        energy_above_hull: bool
+            A flag to read all the rows and get their energies above the hull,
+            if False, the hull is built from the cached lowest energy at each coverage and None is returned for the columns.
+        Returns:
+            tuple: (LowerConvexHull, dict), the hull with the ids of the stable structures in hull.ids,
+            and the columns of read_columns with the energy per unit cell "energy_per_site" and the "energy_above_hull" of each row.
+        """
+        if not energy_above_hull:
+            minima = self.get_coverage_minima()
+            return LowerConvexHull(minima['coverages'], minima['energies'], minima['ids']), None
+        columns = self.read_columns()
+        columns['energy_per_site'] = columns['energy'] / columns['sites']
+        hull = LowerConvexHull(columns['coverages'], columns['energy_per_site'], columns['id'])
+        columns['energy_above_hull'] = hull.energy_above_hull(columns['coverages'], columns['energy_per_site'])
+        return hull, columns
     def validate_with_dft(self, id_list, calculator, fmax=0.03):
         """
         Validate the ML model with single point DFT.
@@ -215,7 +593,7 @@ class MLInfDataProcess:
                 fmax = max(np.linalg.norm(atoms.get_forces(), axis=1))
                 val_energies[i] = (energy, fmax)
         return val_energies
-    def get_structures_to_validate(self, cov_limit, structure_num, cov_must_have=None):
+    def get_structures_to_validate(self, cov_limit, structure_num, cov_must_have=None, stratify=False, bins=None, seed=None):
         """
         Randomly sample the structures in a certain covrage limit to validate.
         cov_limit: [(float, float)]
@@ -224,6 +602,12 @@ class MLInfDataProcess:
             The number of structures to validate.
         cov_must_have: [(float, float)]
             The coverages that the structures must have. Use only when you want to add specific structures to the validation set.
+        stratify: bool
+            A flag to split the coverage limits into bins and sample the same number of coverages from each bin.
+        bins: int or list
+            The number of bins along each adsorbate's coverage limit, if None, each coverage combination is its own bin.
+        seed: int
+            The seed of the random number generator, set it to reproduce a selection.
         """
         convex_hull = self.get_convex_hull()
         if not len(cov_limit) == len(list(convex_hull.keys())[0]):
@@ -240,7 +624,12 @@ class MLInfDataProcess:
                 if lower <= k[i] <= upper:
                     to_validate[k] = convex_hull[k]
             convex_hull = to_validate
-        random_sample = random.sample(list(convex_hull.keys()), structure_num)
+        rng = random.Random(seed)
+        if stratify:
+            binned_covs = ((coverage_bin(k, cov_limit, bins), k) for k in convex_hull.keys())
+            random_sample, _ = stratified_sample(binned_covs, structure_num, rng)
+        else:
+            random_sample = rng.sample(list(convex_hull.keys()), structure_num)
         if cov_must_have is not None:
             for c in cov_must_have:
                 if not c in random_sample:
@@ -0,0 +1,123 @@
+import os, asyncio, logging, time
+from concurrent.futures import ThreadPoolExecutor
+from ase.io.trajectory import Trajectory
+from caxpert.src.tasks.run_dft import CalculateEnergy
+
+class JobFarm:
+    """
+    Run many CalculateEnergy relaxations at once in one Python process.
+    Each relaxation runs in a thread, which mostly waits for the DFT program run by its calculator,
+    and an asyncio semaphore limits how many run at the same time.
+    The failed relaxations are retried from their last frame, and the progress is reported each time a job changes state.
+    """
+    def __init__(self, make_calculator, max_jobs=4, retries=1, fmax=0.03, optimizer='BFGS', optimizer_kwargs=None, progress=None,
+                 warm_start=False, make_surrogate=None, surrogate_fmax=None):
+        """
+        make_calculator: callable
+            Called with the working directory of a job, it returns a new calculator running in that directory,
+            e.g. lambda d: Espresso(..., directory=d). The calculators are not shared between the jobs.
+        max_jobs: int
+            The maximum number of relaxations running at the same time.
+        retries: int
+            The number of times a failed relaxation is started again.
+        fmax: float
+            The maximum force threshold for the relaxations.
+        optimizer: str
+            The optimizer of the relaxations, see CalculateEnergy.
+        optimizer_kwargs: dict
+            The keyword arguments passed to the optimizer.
+        progress: callable
+            Called with the job, its new state and the dict of the number of jobs in each state, by default the progress is logged.
+        warm_start: bool
+            A flag to reuse the electronic state of the previous SCF in each relaxation, see CalculateEnergy.
+        make_surrogate: callable
+            Called with the working directory of a job, it returns the surrogate calculator relaxing the structure before DFT,
+            see CalculateEnergy. A new one per job, since the jobs run in threads. If None, no surrogate is used.
+        surrogate_fmax: float
+            The maximum force for the surrogate relaxations, fmax by default.
+        """
+        self.make_calculator = make_calculator
+        self.max_jobs = max_jobs
+        self.retries = retries
+        self.fmax = fmax
+        self.optimizer = optimizer
+        self.optimizer_kwargs = optimizer_kwargs
+        self.progress = progress or log_progress
+        self.warm_start = warm_start
+        self.make_surrogate = make_surrogate
+        self.surrogate_fmax = surrogate_fmax
+        self.counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+
+    def set_state(self, job, old, new):
+        if old is not None:
+            self.counts[old] -= 1
+        self.counts[new] += 1
+        self.progress(job, new, dict(self.counts))
+
+    def relax(self, init_traj, restart):
+        """
+        Run one relaxation, the working directory is the directory of init_traj, as in CalculateEnergy.
+        """
+        directory = os.path.dirname(init_traj)
+        calc = self.make_calculator(directory)
+        surrogate = self.make_surrogate(directory) if self.make_surrogate is not None else None
+        CalculateEnergy(init_traj, calc, restart=restart, fmax=self.fmax, optimizer=self.optimizer, optimizer_kwargs=self.optimizer_kwargs,
+                        warm_start=self.warm_start, surrogate=surrogate, surrogate_fmax=self.surrogate_fmax).calculate_energy()
+
+    async def run_job(self, init_traj, restart, semaphore, executor):
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                self.set_state(init_traj, 'pending' if attempt == 0 else 'failed', 'running')
+                try:
+                    await loop.run_in_executor(executor, self.relax, init_traj, restart)
+                except Exception as e:
+                    logging.error(f'The relaxation of {init_traj} failed on attempt {attempt + 1}: {e!r}')
+                    self.set_state(init_traj, 'running', 'failed')
+                    # carry on from the last frame if the failed attempt wrote any
+                    restart = has_frames(os.path.join(os.path.dirname(init_traj), 'relax.traj'))
+                else:
+                    self.set_state(init_traj, 'running', 'done')
+                    return 'done'
+        return 'failed'
+
+    async def run(self, init_trajs, restart=False):
+        """
+        Run the relaxations.
+        init_trajs: list
+            The paths to the initial trajectories, one job per path, the jobs must be in different directories.
+        restart: bool
+            A flag to restart the relaxations from their relax.traj, see CalculateEnergy.
+        Returns:
+            dict: {str: str}, the final state of each job, "done" or "failed".
+        """
+        if len(set(os.path.dirname(t) for t in init_trajs)) < len(init_trajs):
+            raise ValueError('Each job must have its own directory, the files of the calculators and relaxations would clash.')
+        semaphore = asyncio.Semaphore(self.max_jobs)
+        for t in init_trajs:
+            self.set_state(t, None, 'pending')
+        with ThreadPoolExecutor(self.max_jobs) as executor:
+            states = await asyncio.gather(*[self.run_job(t, restart, semaphore, executor) for t in init_trajs])
+        return dict(zip(init_trajs, states))
+
+def run_job_farm(init_trajs, make_calculator, max_jobs=4, retries=1, restart=False, fmax=0.03, optimizer='BFGS', optimizer_kwargs=None, progress=None,
+                 warm_start=False, make_surrogate=None, surrogate_fmax=None):
+    """
+    Run the CalculateEnergy relaxations of the initial trajectories with a JobFarm, see JobFarm for the arguments.
+    Returns:
+        dict: {str: str}, the final state of each job, "done" or "failed".
+    """
+    farm = JobFarm(make_calculator, max_jobs, retries, fmax, optimizer, optimizer_kwargs, progress, warm_start, make_surrogate, surrogate_fmax)
+    start_time = time.perf_counter()
+    states = asyncio.run(farm.run(init_trajs, restart))
+    print(f'{farm.counts["done"]} relaxations done, {farm.counts["failed"]} failed in {time.perf_counter() - start_time:.1f} s')
+    return states
+
+def log_progress(job, state, counts):
+    logging.info(f'{job} {state}, ' + ', '.join(f'{k}: {v}' for k, v in counts.items()))
+
+def has_frames(traj_path):
+    if not os.path.exists(traj_path) or os.path.getsize(traj_path) == 0:
+        return False
+    with Trajectory(traj_path) as traj:
+        return len(traj) > 0
@@ -1,14 +1,19 @@
 import os, logging
+import numpy as np
+from contextlib import nullcontext
+from multiprocessing import Pool
 from ase.db import connect
 from ase.io.trajectory import Trajectory
-from fairchem.data.oc.utils import DetectTrajAnomaly
-from ase.neighborlist import NeighborList
+from ase.neighborlist import neighbor_list
 from ase.data import covalent_radii
-import networkx as nx
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from collections import Counter
 from ase.calculators.singlepoint import SinglePointCalculator
+from caxpert.src.utils.frame_selection import FrameSelector
 
 def check_problematic_structs(traj_path):
+    from fairchem.data.oc.utils import DetectTrajAnomaly
     trajs = Trajectory(traj_path)
     unique_tags = set(trajs[0].get_tags())
     for t in unique_tags:
@@ -23,92 +28,160 @@ def check_problematic_structs(traj_path):
         )
     return anom
     
+def composition(numbers):
+    """
+    The hashable composition of a group of atoms, independent of their order.
+    numbers: iterable of int
+        The atomic numbers.
+    Returns:
+        tuple: the sorted (atomic number, count) pairs.
+    """
+    return tuple(sorted(Counter(int(i) for i in numbers).items()))
+
 class MakeTrainingDB:
     """
     A class to create a training database for the machine learning model.
+    The slab and gas reference energies are read once, when the class is created.
     """
-    def __init__(self, file_list, slab_db, ads_db, db_name='training_data/ml_train.db'):
+    def __init__(self, file_list, slab_db, ads_db, db_name='training_data/ml_train.db', skin=0.3, frame_selector=None):
+        """
+        file_list: list
+            The paths to the relax.traj files of the DFT relaxations.
+        slab_db: str
+            The path to the database of the clean slabs, matched to the structures by their cell.
+        ads_db: str
+            The path to the database of the gas references.
+        db_name: str
+            The path to the training database.
+        skin: float
+            Added to the covalent radius of each atom, two atoms are bonded if their spheres overlap.
+        frame_selector: caxpert.src.utils.frame_selection.FrameSelector
+            Selects the frames of each relaxation written to the training database, by default all the frames.
+        """
         self.file_list = file_list
         self.db_name = db_name
+        self.skin = skin
+        self.frame_selector = frame_selector or FrameSelector()
         if not os.path.exists(slab_db):
             raise FileNotFoundError(f'{slab_db} does not exist.')
         self.slab_db = slab_db
         if not os.path.exists(ads_db):
             raise FileNotFoundError(f'{ads_db} does not exist.')
         self.ads_db = ads_db
-    
+        self.slab_energies = dict()
+        with connect(self.slab_db) as db:
+            for i in db.select():
+                atoms = i.toatoms()
+                self.slab_energies[atoms.cell.cellpar().tobytes()] = atoms.get_potential_energy()
+        # the gas references by formula, and their formulas by composition to match the adsorbates in one lookup
+        self.gas_ref_energies = dict()
+        self.gas_ref_formulas = dict()
+        with connect(self.ads_db) as db:
+            for i in db.select():
+                atoms = i.toatoms()
+                formula = atoms.get_chemical_formula()
+                key = composition(atoms.numbers)
+                if key in self.gas_ref_formulas:
+                    logging.warning(f'The gas references {self.gas_ref_formulas[key]} and {formula} have the same composition, '
+                                    f'only the last one, row {i.id}, is used.')
+                self.gas_ref_energies[formula] = atoms.get_potential_energy()
+                self.gas_ref_formulas[key] = formula
+
+    def find_adsorbates(self, atoms):
+        """
+        Find the adsorbates in the structure, the connected groups of the adsorbate atoms (tag 2) and their bonded atoms,
+        except the surface atoms (tag 1).
+        atoms: ase.Atoms
+            The structure to search.
+        Returns:
+            list: the numpy.ndarray indices of the atoms of each adsorbate.
+        """
+        tags = atoms.get_tags()
+        i, j = neighbor_list('ij', atoms, covalent_radii[atoms.numbers] + self.skin)
+        bonded = (tags[i] == 2) & (tags[j] != 1)
+        i, j = i[bonded], j[bonded]
+        nodes = np.union1d(np.flatnonzero(tags == 2), j)
+        graph = coo_matrix((np.ones(len(i), dtype=bool), (i, j)), shape=(len(atoms), len(atoms)))
+        _, labels = connected_components(graph, directed=False)
+        labels = labels[nodes]
+        return [nodes[labels == label] for label in np.unique(labels)]
+
     def count_adsorbates(self, atoms):
         """
         Count the different adsorbates in the structure.
         atoms: ase.Atoms
             The structure to count the adsorbates.
+        Returns:
+            dict: {str: int}, the number of each gas reference by formula, the adsorbates without a gas reference are not counted.
         """
-        radiis = [covalent_radii[i] for i in atoms.get_atomic_numbers()]
-        nl = NeighborList(radiis, self_interaction=False, bothways=True)
-        nl.update(atoms)
-        adsorbates = [atom for atom in atoms if atom.tag==2]
-        G = nx.Graph()
-        for a in adsorbates:
-            G.add_node(a.index)
-        
-        for a in adsorbates:
-            neighbor_list = nl.get_neighbors(a.index)[0]
-            neighbor_list = [j for j in neighbor_list if atoms[j].tag != 1]
-            for j in neighbor_list:
-                G.add_edge(a.index, j)
-
-        components = list(nx.connected_components(G))
-        component_symbols = []
-        for node in components:
-            component_symbols.append([atoms[i].symbol for i in node])
-        
-        adsorbate_counts = dict()
-        gas_refs = []
-        with connect(self.ads_db) as db:
-            for i in db.select():
-                atms = i.toatoms()
-                adsorbate_counts[atms.get_chemical_formula()] = 0
-                gas_refs.append(atms)
-        
-        for i in component_symbols:
-            for j in gas_refs:
-                if Counter(i) == Counter(j.get_chemical_symbols()):
-                    adsorbate_counts[j.get_chemical_formula()] += 1
+        adsorbate_counts = dict.fromkeys(self.gas_ref_energies, 0)
+        for adsorbate in self.find_adsorbates(atoms):
+            formula = self.gas_ref_formulas.get(composition(atoms.numbers[adsorbate]))
+            if formula is not None:
+                adsorbate_counts[formula] += 1
         return adsorbate_counts
 
-    def create_ase_database(self):
-        slabs = dict()
-        gas_refs = dict()
-        with connect(self.slab_db) as db:
-            for i in db.select():
-                atoms = i.toatoms()
-                slabs[atoms.cell.cellpar().tobytes()] = atoms
-        
-        with connect(self.ads_db) as db:
-            for i in db.select():
-                atoms = i.toatoms()
-                gas_refs[atoms.get_chemical_formula()] = atoms
+    def read_frames(self, file):
+        """
+        Read the frames of a relaxation chosen by the frame selector, with their binding energies as the energies.
+        file: str
+            The path to the relax.traj file.
+        Returns:
+            tuple: (list, int), the selected ase.Atoms frames, empty if the relaxation is skipped, and the number of frames in the file.
+        """
+        with Trajectory(file) as trajs:
+            frame_num = len(trajs)
+        if check_problematic_structs(file):
+            logging.warning(f'{file} has problematic structures, skip it.')
+            return [], frame_num
+        with Trajectory(file) as trajs:
+            frames = self.frame_selector.select(trajs)
+        ads_counts = self.count_adsorbates(frames[0])
+        gas_ref_e = sum([self.gas_ref_energies[i]*j for i, j in ads_counts.items()])
+        if gas_ref_e == 0:
+            logging.warning(f'The gas reference energy is 0, skip it.')
+            return [], frame_num
+        slab_e = self.slab_energies[frames[0].cell.cellpar().tobytes()]
+        for traj in frames:
+            binding_energy = traj.get_potential_energy() - slab_e - gas_ref_e
+            traj.calc = SinglePointCalculator(traj, energy=binding_energy, forces=traj.get_forces())
+        return frames, frame_num
 
+    def create_ase_database(self, processes=1, chunk_size=1000):
+        """
+        Write the selected frames of the relaxations to the training database.
+        processes: int
+            The number of processes reading the relax.traj files, the database is written by this process only
+            and the files are written in the order of file_list.
+        chunk_size: int
+            The number of frames written to the database in each transaction.
+        """
         db_dir = os.path.dirname(self.db_name)
         
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir, exist_ok=True)
 
-        with connect(self.db_name) as db:
-            for file in self.file_list:
-                if check_problematic_structs(file):
-                    logging.warning(f'{file} has problematic structures, skip it.')
-                    continue
-                trajs = Trajectory(file)
-                ads_counts = self.count_adsorbates(trajs[0])
-                gas_ref_e = sum([gas_refs[i].get_potential_energy()*j for i, j in ads_counts.items()])
-                if gas_ref_e == 0:
-                    logging.warning(f'The gas reference energy is 0, skip it.')
-                    continue
-                slab_e = slabs[trajs[0].cell.cellpar().tobytes()].get_potential_energy()
-                for traj in trajs:
-                    binding_energy = traj.get_potential_energy() - slab_e - gas_ref_e
-                    calc = SinglePointCalculator(traj, energy=binding_energy, forces=traj.get_forces())
-                    traj.set_calculator(calc)
-                    db.write(traj)
-        logging.info(f'The training database is created at {self.db_name}')
+        with Pool(processes) if processes > 1 else nullcontext() as pool:
+            results = pool.imap(self.read_frames, self.file_list) if pool is not None else map(self.read_frames, self.file_list)
+            db = connect(self.db_name)
+            chunk = []
+            frame_num = written_num = skipped_num = 0
+            for frames, n in results:
+                chunk.extend(frames)
+                frame_num += n
+                written_num += len(frames)
+                skipped_num += not frames
+                if len(chunk) >= chunk_size:
+                    write_frames(db, chunk)
+                    chunk = []
+            write_frames(db, chunk)
+        logging.info(f'{written_num} of {frame_num} frames are written, {skipped_num} of {len(self.file_list)} files are skipped, '
+                     f'the training database is created at {self.db_name}')
+
+def write_frames(db, frames):
+    """
+    Write the frames to the database in one transaction.
+    """
+    with db:
+        for traj in frames:
+            db.write(traj)
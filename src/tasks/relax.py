@@ -0,0 +1,439 @@
+import os, time, random
+import numpy as np
+from functools import partial
+from itertools import islice
+from ase.io.trajectory import Trajectory
+from ase.optimize import BFGS, FIRE, LBFGS
+from ase.optimize.precon import PreconLBFGS
+from ase.calculators.singlepoint import SinglePointCalculator
+from ase.constraints import FixAtoms
+from caxpert.src.utils.utils import reservoir_sample
+
+optimizers = {'BFGS': BFGS, 'FIRE': FIRE, 'LBFGS': LBFGS, 'PreconLBFGS': PreconLBFGS}
+
+def get_optimizer(name='BFGS', **kwargs):
+    """
+    Get an ASE optimizer by name.
+    name: str
+        One of "BFGS", "FIRE", "LBFGS" or "PreconLBFGS".
+        BFGS stores the full 3N x 3N Hessian, LBFGS only keeps the last "memory" steps (100 by default),
+        and PreconLBFGS is LBFGS with a preconditioner built from the interatomic distances ("Exp" by default).
+    kwargs:
+        The keyword arguments passed to the optimizer, e.g. memory=20 for LBFGS.
+    Returns:
+        callable: the optimizer class with the keyword arguments set, called as optimizer(atoms, logfile=..., trajectory=...).
+    """
+    if name not in optimizers:
+        raise ValueError(f'The optimizer {name} is not supported, choose one of {list(optimizers.keys())}.')
+    if name == 'PreconLBFGS':
+        kwargs.setdefault('precon', 'Exp')
+    return partial(optimizers[name], **kwargs)
+
+def benchmark_optimizers(structures, calculator, names=('BFGS', 'FIRE', 'LBFGS', 'PreconLBFGS'), fmax=0.05, steps=300, optimizer_kwargs=None):
+    """
+    Relax the same structures with each optimizer and report the steps to converge and the wall time.
+    structures: list
+        The ase.Atoms objects to relax, they are copied for each optimizer.
+    calculator: ase.calculators.calculator.Calculator
+        The calculator used for all the relaxations.
+    names: list
+        The names of the optimizers to compare.
+    fmax: float
+        The maximum force for the relaxation.
+    steps: int
+        The maximum number of steps for the relaxation.
+    optimizer_kwargs: dict, {str: dict}
+        The keyword arguments passed to each optimizer.
+    Returns:
+        dict: the results of each optimizer, with the keys "steps" (the steps of each structure),
+        "converged" (the number of converged structures) and "time" (the wall time in seconds).
+    """
+    optimizer_kwargs = optimizer_kwargs or dict()
+    results = dict()
+    for name in names:
+        optimizer = get_optimizer(name, **optimizer_kwargs.get(name, dict()))
+        struct_steps = []
+        converged_num = 0
+        start_time = time.perf_counter()
+        for atoms in structures:
+            atoms = atoms.copy()
+            atoms.calc = calculator
+            opt = optimizer(atoms, logfile=None)
+            converged_num += bool(opt.run(fmax=fmax, steps=steps))
+            struct_steps.append(opt.nsteps)
+        results[name] = {'steps': struct_steps, 'converged': converged_num, 'time': time.perf_counter() - start_time}
+        print(f'{name}: {np.mean(struct_steps):.1f} steps on average, {converged_num}/{len(structures)} converged, {results[name]["time"]:.2f} s')
+    return results
+
+def surrogate_hessian(atoms, calculator, delta=0.01, min_curvature=1.0, alpha=70.0):
+    """
+    Approximate the Hessian of a structure with central finite differences of the forces of a cheap calculator.
+    atoms: ase.Atoms
+        The structure, usually relaxed with the same calculator.
+    calculator: ase.calculators.calculator.Calculator
+        The surrogate calculator, e.g. an OCPCalculator or EMT.
+    delta: float
+        The displacement of the finite differences in A.
+    min_curvature: float
+        The eigenvalues are raised to at least min_curvature (eV/A^2), so the Hessian is positive definite.
+    alpha: float
+        The curvature of the coordinates of the atoms fixed by FixAtoms, which are not displaced, 70 as in ASE BFGS.
+    Returns:
+        numpy.ndarray: the (3N, 3N) Hessian in eV/A^2.
+    """
+    atoms = atoms.copy()
+    atoms.calc = calculator
+    free = np.ones(len(atoms), dtype=bool)
+    for c in atoms.constraints:
+        if isinstance(c, FixAtoms):
+            free[c.index] = False
+    atoms.set_constraint()
+    hessian = np.eye(3 * len(atoms)) * alpha
+    positions = atoms.get_positions()
+    dofs = [3 * i + j for i in np.flatnonzero(free) for j in range(3)]
+    for dof in dofs:
+        forces = []
+        for sign in (1, -1):
+            displaced = positions.copy()
+            displaced.reshape(-1)[dof] += sign * delta
+            atoms.set_positions(displaced)
+            forces.append(atoms.get_forces().reshape(-1))
+        hessian[dof, dofs] = -(forces[0] - forces[1])[dofs] / (2 * delta)
+    hessian = (hessian + hessian.T) / 2
+    values, vectors = np.linalg.eigh(hessian)
+    return (vectors * np.maximum(values, min_curvature)) @ vectors.T
+
+def surrogate_precondition(atoms, surrogate, fmax=0.05, steps=300, hessian=True, optimizer=BFGS):
+    """
+    Relax a structure with a cheap surrogate calculator before the expensive relaxation.
+    The positions of atoms are set to the surrogate minimum.
+    atoms: ase.Atoms
+        The structure to relax, its calculator is not used.
+    surrogate: ase.calculators.calculator.Calculator
+        The surrogate calculator.
+    fmax: float
+        The maximum force for the surrogate relaxation.
+    steps: int
+        The maximum number of steps for the surrogate relaxation.
+    hessian: bool
+        A flag to approximate the Hessian at the surrogate minimum, see surrogate_hessian.
+        It costs 6 force calls of the surrogate per free atom, so only set it if the next relaxation uses BFGS, see uses_hessian.
+    optimizer: callable
+        The optimizer of the surrogate relaxation, e.g. from get_optimizer, usually the optimizer of the expensive relaxation.
+    Returns:
+        tuple: (numpy.ndarray or None, int), the Hessian to start BFGS with and the number of steps of the surrogate relaxation.
+    """
+    relaxed = atoms.copy()
+    relaxed.calc = surrogate
+    opt = optimizer(relaxed, logfile=None)
+    opt.run(fmax=fmax, steps=steps)
+    atoms.set_positions(relaxed.get_positions())
+    return surrogate_hessian(relaxed, surrogate) if hessian else None, opt.nsteps
+
+def uses_hessian(optimizer):
+    """
+    Check if an optimizer, e.g. from get_optimizer, starts from a Hessian that seed_hessian can set.
+    """
+    optimizer = optimizer.func if isinstance(optimizer, partial) else optimizer
+    return isinstance(optimizer, type) and issubclass(optimizer, BFGS)
+
+def seed_hessian(opt, hessian):
+    """
+    Start a BFGS optimizer with the Hessian, the optimizers without a Hessian are left as they are.
+    Both the ASE versions keeping the Hessian in opt.H and in opt.state build it from opt.H0 at the first step.
+    Returns:
+        bool: True if the Hessian was set.
+    """
+    if hessian is None or not isinstance(opt, BFGS):
+        return False
+    opt.H0 = hessian
+    return True
+
+class ASEBatchCalculator:
+    """
+    Evaluate a batch of structures one by one with an ASE calculator.
+    It lets the batched relaxations run with any ASE calculator, e.g. EMT for tests on CPU.
+    """
+    def __init__(self, calculator):
+        """
+        calculator: ase.calculators.calculator.Calculator
+            The ASE calculator to evaluate the structures with.
+        """
+        self.calculator = calculator
+
+    def calculate(self, atoms_list):
+        """
+        Calculate the energies and forces of a batch of structures.
+        atoms_list: list
+            The ase.Atoms objects to evaluate.
+        Returns:
+            tuple: (list, list), the energy and the (natoms, 3) forces array of each structure.
+        """
+        energies = []
+        forces = []
+        for atoms in atoms_list:
+            atoms = atoms.copy()
+            atoms.calc = self.calculator
+            energies.append(atoms.get_potential_energy())
+            forces.append(atoms.get_forces(apply_constraint=False))
+        return energies, forces
+
+class OCPBatchCalculator:
+    """
+    Evaluate a batch of structures with a single forward pass of an OCP model.
+    """
+    def __init__(self, calculator):
+        """
+        calculator: fairchem.core.common.relaxation.ase_utils.OCPCalculator
+            The calculator holding the loaded model, its graph converter and trainer are reused.
+        """
+        self.calculator = calculator
+
+    def calculate(self, atoms_list):
+        """
+        Calculate the energies and forces of a batch of structures.
+        atoms_list: list
+            The ase.Atoms objects to evaluate.
+        Returns:
+            tuple: (numpy.ndarray, list), the energy and the (natoms, 3) forces array of each structure.
+        """
+        from fairchem.core.datasets import data_list_collater
+        data_list = [self.calculator.a2g.convert(atoms) for atoms in atoms_list]
+        batch = data_list_collater(data_list, otf_graph=True)
+        predictions = self.calculator.trainer.predict(batch, per_image=False, disable_tqdm=True)
+        energies = predictions['energy'].detach().cpu().numpy().reshape(-1)
+        forces = predictions['forces'].detach().cpu().numpy()
+        return energies, np.split(forces, np.cumsum([len(atoms) for atoms in atoms_list])[:-1])
+
+class BatchRelaxer:
+    """
+    Relax many structures together, the forces of all the structures in the batch are evaluated with one call per step.
+    Each structure keeps its own optimizer, the converged structures leave the batch and the next structures take their place.
+    """
+    def __init__(self, batch_calculator, batch_size=32, fmax=0.03, steps=300, optimizer='BFGS'):
+        """
+        batch_calculator: ASEBatchCalculator or OCPBatchCalculator
+            The calculator evaluating the batches.
+        batch_size: int
+            The maximum number of structures relaxed together.
+        fmax: float
+            The maximum force for the relaxation.
+        steps: int
+            The maximum number of steps for the relaxation.
+        optimizer: str or callable
+            The name of the optimizer used for each structure, see get_optimizer, or the optimizer class.
+            The optimizers evaluating the forces inside their step with a line search (PreconLBFGS) can not be batched.
+        """
+        self.batch_calculator = batch_calculator
+        self.batch_size = batch_size
+        self.fmax = fmax
+        self.steps = steps
+        self.optimizer = get_optimizer(optimizer) if isinstance(optimizer, str) else optimizer
+        if getattr(self.optimizer, 'func', self.optimizer) is PreconLBFGS:
+            raise ValueError('PreconLBFGS evaluates the forces in its line search, it can not be used in batched relaxations.')
+
+    def run(self, structures):
+        """
+        Relax the structures and yield them in the input order.
+        structures: iterable of (object, ase.Atoms)
+            The key identifying each structure, e.g. its id in the database, and the structure to relax.
+        Yields:
+            tuple: (object, ase.Atoms, dict), the key, the relaxed structure with a SinglePointCalculator holding
+            its energy and forces, and a dictionary with the keys "energy", "fmax", "steps" and "converged".
+        """
+        structures = iter(structures)
+        active = []
+        done = dict()
+        order = 0
+        next_order = 0
+        exhausted = False
+        while True:
+            while not exhausted and len(active) < self.batch_size:
+                try:
+                    key, atoms = next(structures)
+                except StopIteration:
+                    exhausted = True
+                    break
+                active.append({'order': order, 'key': key, 'atoms': atoms, 'steps': 0,
+                               'optimizer': self.optimizer(atoms, logfile=None)})
+                order += 1
+            if not active:
+                break
+            energies, forces = self.batch_calculator.calculate([s['atoms'] for s in active])
+            still_active = []
+            for s, energy, force in zip(active, energies, forces):
+                atoms = s['atoms']
+                atoms.calc = SinglePointCalculator(atoms, energy=float(energy), forces=np.asarray(force))
+                fmax = np.sqrt((atoms.get_forces() ** 2).sum(axis=1).max())
+                converged = fmax < self.fmax
+                if converged or s['steps'] >= self.steps:
+                    result = {'energy': float(energy), 'fmax': float(fmax), 'steps': s['steps'], 'converged': bool(converged)}
+                    done[s['order']] = (s['key'], atoms, result)
+                else:
+                    s['optimizer'].step()
+                    s['steps'] += 1
+                    still_active.append(s)
+            active = still_active
+            while next_order in done:
+                yield done.pop(next_order)
+                next_order += 1
+
+class ResultStore:
+    """
+    Store the relaxed structures as the final frames in a .traj file and one fixed-width record per structure in a .rec file.
+    A record holds the source id of the structure in the input database, the index of its frame in the .traj file,
+    the energy, the maximum force, the number of steps and the converged flag.
+    The records are appended after their frames, so a structure is done once its record is written,
+    a frame without a record left by an interrupted task is never referenced and its structure is relaxed again.
+    """
+    dtype = np.dtype([('source_id', '<i8'), ('frame', '<i8'), ('energy', '<f8'), ('fmax', '<f8'), ('steps', '<i4'), ('converged', '?')])
+
+    def __init__(self, prefix, calculator_name=None):
+        """
+        prefix: str
+            The path of the files without the extension, the files are written to prefix.traj and prefix.rec.
+        calculator_name: str
+            The name of the calculator of the relaxations, written with the frames whose calculator is a SinglePointCalculator,
+            e.g. the frames of the batched relaxations, so every frame names the calculator that computed it.
+        """
+        self.traj_path = prefix + '.traj'
+        self.records_path = prefix + '.rec'
+        self.calculator_name = calculator_name
+        self.traj = None
+        self.records = None
+
+    def __enter__(self):
+        self.truncate_partial_record()
+        self.traj = Trajectory(self.traj_path, 'a')
+        self.records = open(self.records_path, 'ab')
+        return self
+
+    def __exit__(self, *args):
+        self.traj.close()
+        self.records.close()
+
+    def truncate_partial_record(self):
+        """
+        Remove the incomplete record left at the end of the .rec file by an interrupted write.
+        """
+        if os.path.exists(self.records_path):
+            size = os.path.getsize(self.records_path)
+            if size % self.dtype.itemsize:
+                with open(self.records_path, 'r+b') as f:
+                    f.truncate(size - size % self.dtype.itemsize)
+
+    def append(self, source_id, atoms, result):
+        """
+        Append a relaxed structure and its record.
+        source_id: int
+            The id of the structure in the input database.
+        atoms: ase.Atoms
+            The relaxed structure with its calculator.
+        result: dict
+            The relaxation result with the keys "energy", "fmax", "steps" and "converged".
+        """
+        frame = len(self.traj)
+        if self.calculator_name is not None and isinstance(atoms.calc, SinglePointCalculator):
+            # the name is read back into the SinglePointCalculator of the frame
+            atoms.calc.name = self.calculator_name
+        self.traj.write(atoms)
+        record = np.array([(source_id, frame, result['energy'], result['fmax'], result['steps'], result['converged'])], dtype=self.dtype)
+        self.records.write(record.tobytes())
+        self.records.flush()
+
+    def __len__(self):
+        if not os.path.exists(self.records_path):
+            return 0
+        return os.path.getsize(self.records_path) // self.dtype.itemsize
+
+    def done_ids(self):
+        """
+        Get the source ids of the stored structures, only the .rec file is read.
+        Returns:
+            set: the source ids with a complete record.
+        """
+        return set(int(i) for i in self.read_records()['source_id'])
+
+    def read_records(self):
+        """
+        Read all the complete records.
+        Returns:
+            numpy.ndarray: the records as a structured array with the fields of ResultStore.dtype.
+        """
+        return np.fromfile(self.records_path, dtype=self.dtype, count=len(self)) if len(self) else np.empty(0, dtype=self.dtype)
+
+# the per-structure errors written by validate_batches, read them with np.fromfile(errors_path, dtype=validation_dtype)
+validation_dtype = np.dtype([('id', '<i8'), ('natoms', '<i4'), ('energy', '<f8'), ('energy_pred', '<f8'),
+                             ('force_mae', '<f8'), ('force_rmse', '<f8'), ('fmax', '<f8'), ('fmax_pred', '<f8')])
+
+def validate_batches(structures, batch_calculator, batch_size=32, errors_path=None, plot_points=None, rng=random):
+    """
+    Evaluate the structures in batches and accumulate the energy and force errors against their reference results.
+    Only one batch is kept in memory, besides the energies of the structures for the parity plot.
+    structures: iterable of (int, ase.Atoms)
+        The id and the structure with a calculator holding the reference energy and forces, e.g. from row.toatoms().
+    batch_calculator: ASEBatchCalculator or OCPBatchCalculator
+        The calculator evaluating the batches.
+    batch_size: int
+        The number of structures evaluated together.
+    errors_path: str
+        The path to write the errors of each structure as fixed-width records of validation_dtype, not written if None.
+    plot_points: int
+        The maximum number of structures whose energies are returned, sampled uniformly with reservoir_sample,
+        so the memory stays bounded on large test sets. If None, the energies of all the structures are returned.
+    rng: random.Random
+        The random number generator of the sampling.
+    Returns:
+        tuple: (dict, numpy.ndarray, numpy.ndarray), the metrics, the reference energies and the predicted energies.
+        The metrics are the number of structures, the energy MAE and RMSE in eV, the force MAE and RMSE in eV/A over
+        the force components of the atoms not fixed by FixAtoms, and the MSE of the maximum force of each structure.
+    """
+    sums = {'energy_abs': 0.0, 'energy_sq': 0.0, 'force_abs': 0.0, 'force_sq': 0.0, 'fmax_sq': 0.0, 'force_num': 0, 'struct_num': 0}
+    errors = open(errors_path, 'wb') if errors_path else None
+
+    def evaluate():
+        batches = iter(structures)
+        while True:
+            batch = list(islice(batches, batch_size))
+            if not batch:
+                return
+            pred_energies, pred_forces = batch_calculator.calculate([atoms for _, atoms in batch])
+            records = np.zeros(len(batch), dtype=validation_dtype)
+            for record, (key, atoms), energy_pred, forces_pred in zip(records, batch, pred_energies, pred_forces):
+                energy = atoms.get_potential_energy()
+                forces = atoms.get_forces(apply_constraint=False)
+                free = np.ones(len(atoms), dtype=bool)
+                for c in atoms.constraints:
+                    if isinstance(c, FixAtoms):
+                        free[c.index] = False
+                diff = (np.asarray(forces_pred) - forces)[free]
+                fmax = np.linalg.norm(forces[free], axis=1).max(initial=0.0)
+                fmax_pred = np.linalg.norm(np.asarray(forces_pred)[free], axis=1).max(initial=0.0)
+                sums['energy_abs'] += abs(energy_pred - energy)
+                sums['energy_sq'] += (energy_pred - energy) ** 2
+                sums['force_abs'] += np.abs(diff).sum()
+                sums['force_sq'] += (diff ** 2).sum()
+                sums['fmax_sq'] += (fmax_pred - fmax) ** 2
+                sums['force_num'] += diff.size
+                sums['struct_num'] += 1
+                record['id'], record['natoms'], record['energy'], record['energy_pred'] = key, len(atoms), energy, energy_pred
+                record['force_mae'] = np.abs(diff).mean() if diff.size else 0.0
+                record['force_rmse'] = np.sqrt((diff ** 2).mean()) if diff.size else 0.0
+                record['fmax'], record['fmax_pred'] = fmax, fmax_pred
+                yield energy, energy_pred
+            if errors is not None:
+                errors.write(records.tobytes())
+
+    try:
+        points = list(evaluate()) if plot_points is None else reservoir_sample(evaluate(), plot_points, rng)[0]
+    finally:
+        if errors is not None:
+            errors.close()
+    struct_num = max(sums['struct_num'], 1)
+    force_num = max(sums['force_num'], 1)
+    metrics = {'struct_num': sums['struct_num'],
+               'energy_mae': sums['energy_abs'] / struct_num, 'energy_rmse': np.sqrt(sums['energy_sq'] / struct_num),
+               'force_mae': sums['force_abs'] / force_num, 'force_rmse': np.sqrt(sums['force_sq'] / force_num),
+               'fmax_mse': sums['fmax_sq'] / struct_num}
+    points = np.array(points, dtype=float).reshape(-1, 2)
+    return metrics, points[:, 0], points[:, 1]
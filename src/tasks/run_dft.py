@@ -1,11 +1,13 @@
 # This script only work for fcc111 currently
 # it only 
-import os, logging
+import os, copy, logging, time, sqlite3, json
+from contextlib import nullcontext
+from multiprocessing import Pool
 from ase.io.trajectory import Trajectory
-from ase.optimize import BFGS
 from ase.db import connect
 from caxpert.src.utils.utils import timeit
 from caxpert.src.utils.error import StructuresNotValidatedError
+from caxpert.src.tasks.relax import get_optimizer, surrogate_precondition, seed_hessian, uses_hessian
 import numpy as np
 from ase.calculators.singlepoint import SinglePointCalculator
 
@@ -26,16 +28,91 @@ class CalculateEnergy:
     
     restart: bool
         A flag to indicate if the calculation is a restart from a previous calculation,
-        if True, the last structure from the init_traj is read and the new calculations are appended to the trajectory.
+        if True, the last structure of relax.traj next to the init_traj is read and the new calculations are appended to relax.traj.
+
+    optimizer: str
+        The optimizer of the relaxations, one of "BFGS", "FIRE", "LBFGS" or "PreconLBFGS".
+
+    optimizer_kwargs: dict
+        The keyword arguments passed to the optimizer, e.g. {'memory': 20} for LBFGS.
+
+    warm_start: bool
+        A flag to start each SCF from the wavefunctions and charge density of the previous ionic step,
+        also after a restart, only for Quantum Espresso, see WarmStart.
+
+    surrogate: ase.calculators.calculator.Calculator
+        A cheap calculator, e.g. an OCPCalculator, relaxing the structure with the same optimizer before the DFT relaxation,
+        which starts from the surrogate minimum, and from the surrogate Hessian if the optimizer is BFGS.
+        It is not used when restarting.
+
+    surrogate_fmax: float
+        The maximum force for the surrogate relaxation, fmax by default.
     """
-    def __init__(self, init_traj, calculator, restart=False, fmax=0.03):
+    def __init__(self, init_traj, calculator, restart=False, fmax=0.03, optimizer='BFGS', optimizer_kwargs=None, warm_start=False,
+                 surrogate=None, surrogate_fmax=None):
         self.init_traj = init_traj
         self.calculator = calculator
         self.restart = restart
         self.fmax = fmax
+        self.optimizer = get_optimizer(optimizer, **(optimizer_kwargs or dict()))
+        self.warm_start = warm_start
+        self.surrogate = surrogate
+        self.surrogate_fmax = surrogate_fmax or fmax
+
+    def relax(self, adslab, logfile, trajectory, surrogate=True, warm_start_key=None):
+        """
+        Relax the structure with the DFT calculator, after the surrogate relaxation if a surrogate is set.
+        warm_start_key: str
+            Keeps the saved electronic state of each structure apart when the structures share the calculator directory, see WarmStart.
+        Returns:
+            int: the number of DFT steps.
+        """
+        hessian = None
+        if surrogate and self.surrogate is not None:
+            hessian, surrogate_steps = surrogate_precondition(adslab, self.surrogate, fmax=self.surrogate_fmax,
+                                                              hessian=uses_hessian(self.optimizer), optimizer=self.optimizer)
+        adslab.calc = self.calculator
+        opt_slab = self.optimizer(adslab, logfile=logfile, trajectory=trajectory)
+        seeded = seed_hessian(opt_slab, hessian)
+        warm_start = self.attach_warm_start(opt_slab, warm_start_key)
+        try:
+            opt_slab.run(fmax=self.fmax)
+        finally:
+            if warm_start is not None:
+                warm_start.restore()
+        self.report_warm_start(warm_start, logfile)
+        if surrogate and self.surrogate is not None:
+            # the DFT steps saved can only be measured against a DFT relaxation without the surrogate, see benchmark_surrogate
+            with open(logfile, 'a') as f:
+                f.write(f"Surrogate steps: {surrogate_steps}, DFT steps from the surrogate minimum: {opt_slab.nsteps}"
+                        f"{' with the surrogate Hessian' if seeded else ''}\n")
+        return opt_slab.nsteps
+
+    def attach_warm_start(self, opt_slab, key=None):
+        """
+        Reuse the electronic state of the previous SCF in the relaxation and log the SCF iterations saved at the end.
+        The parameters of the calculator must be restored with WarmStart.restore after the relaxation.
+        """
+        if not self.warm_start:
+            return None
+        if getattr(self.calculator, 'name', None) != 'espresso':
+            logging.warning('The warm start is only implemented for Quantum Espresso, the SCFs start from scratch.')
+            return None
+        warm_start = WarmStart(self.calculator, key)
+        opt_slab.attach(warm_start)
+        return warm_start
+
+    @staticmethod
+    def report_warm_start(warm_start, logfile):
+        if warm_start is None:
+            return
+        report = warm_start.report()
+        with open(logfile, 'a') as f:
+            f.write(f"SCF iterations: {report['scf_iterations']}, cold start: {report['cold_iterations']}, saved by the warm start: {report['saved_iterations']}\n")
     
     @classmethod
-    def init_for_db(cls, db_path, calculator, restart=False, fmax=0.03):
+    def init_for_db(cls, db_path, calculator, restart=False, fmax=0.03, optimizer='BFGS', optimizer_kwargs=None, warm_start=False,
+                    surrogate=None, surrogate_fmax=None):
         """
         Initialize the class from a database entry.
 
@@ -45,8 +122,18 @@ class CalculateEnergy:
             An ASE calculator instance configured for the DFT calculation.
         fmax: float
             The maximum force threshold for the relaxation.
+        optimizer: str
+            The optimizer of the relaxations.
+        optimizer_kwargs: dict
+            The keyword arguments passed to the optimizer.
+        warm_start: bool
+            A flag to reuse the electronic state of the previous SCF.
+        surrogate: ase.calculators.calculator.Calculator
+            A cheap calculator relaxing the structures before the DFT relaxations.
+        surrogate_fmax: float
+            The maximum force for the surrogate relaxations.
         """
-        return cls(db_path, calculator, restart, fmax)
+        return cls(db_path, calculator, restart, fmax, optimizer, optimizer_kwargs, warm_start, surrogate, surrogate_fmax)
 
     @timeit
     def calculate_energy(self):
@@ -54,21 +141,26 @@ class CalculateEnergy:
         traj_file = os.path.join(parent_dir, 'relax.traj')
         logfile = os.path.join(parent_dir, 'ase.log')
         if self.restart:
-            adslab = Trajectory(traj_file)[-1]
+            with Trajectory(traj_file) as traj:
+                adslab = traj[-1]
             if np.max(np.linalg.norm(adslab.get_forces(), axis=1))<=self.fmax:
                 logging.warning(f'Structure is relaxed under the force threshold, terminate it.')
                 return 0
-            traj_file = Trajectory(self.init_traj, 'a', adslab)
+            # append to the trajectory read above, so the next restart carries on from the last frame
+            traj_file = Trajectory(traj_file, 'a', adslab)
         else:
             adslab = Trajectory(self.init_traj)[0]
         with open(logfile, 'a') as f:
             f.write(f"Start DFT calculation:\n")
         if not adslab.constraints:
             logging.warning('The structure has no constraints, please make sure you do not need it!')
-        adslab.calc = self.calculator
-        opt_slab = BFGS(adslab, logfile=logfile, trajectory=traj_file)
-        opt_slab.run(fmax=self.fmax)
+        try:
+            steps = self.relax(adslab, logfile, traj_file, surrogate=not self.restart)
+        finally:
+            if self.restart:
+                traj_file.close()
         print('Done!')
+        return steps
     
     @timeit
     def calculate_energy_from_db(self, struct_id, output_path):
@@ -95,17 +187,144 @@ class CalculateEnergy:
         if f_max >= self.fmax:
             if not adslab.constraints:
                 logging.warning('The structure has no constraints, please make sure you do not need it!')
-            adslab.calc = self.calculator
             with open(logfile, 'a') as f:
                 f.write(f"Start DFT calculation with the bottom 2 layers fixed:\n")
-            opt_slab = BFGS(adslab, logfile=logfile, trajectory=output_path)
-            opt_slab.run(fmax=self.fmax)
+            self.relax(adslab, logfile, output_path, warm_start_key=f'struct_{struct_id}')
         else:
             print(f'Structure {struct_id} is relaxed under the force threshold, skip it.')
 
-def ml_val(strut_ids, db_path, calculator,output_db, restart=False):
+def benchmark_surrogate(structures, make_calculator, surrogate, work_dir='surrogate_benchmark', fmax=0.03, surrogate_fmax=None,
+                        optimizer='BFGS', optimizer_kwargs=None):
+    """
+    Measure the DFT steps saved by the surrogate, each structure is relaxed with DFT from scratch and from the surrogate minimum.
+    Run it on a sample of the structures, it doubles their DFT cost.
+    structures: list
+        The ase.Atoms objects to relax.
+    make_calculator: callable
+        Called with the working directory of a relaxation, it returns a new DFT calculator running in that directory.
+    surrogate: ase.calculators.calculator.Calculator
+        The surrogate calculator, see CalculateEnergy.
+    work_dir: str
+        The relaxations run in work_dir/{INDEX}/baseline and work_dir/{INDEX}/surrogate.
+    Returns:
+        dict: the DFT steps of each structure without ("baseline_steps") and with the surrogate ("surrogate_steps"),
+        their total difference ("saved_steps") and the wall times in seconds ("baseline_time" and "surrogate_time").
+    """
+    results = {'baseline_steps': [], 'surrogate_steps': [], 'baseline_time': 0.0, 'surrogate_time': 0.0}
+    for i, atoms in enumerate(structures):
+        for mode, s in (('baseline', None), ('surrogate', surrogate)):
+            directory = os.path.join(work_dir, str(i), mode)
+            os.makedirs(directory, exist_ok=True)
+            init_traj = os.path.join(directory, 'init.traj')
+            with Trajectory(init_traj, 'w') as traj:
+                traj.write(atoms)
+            start_time = time.perf_counter()
+            steps = CalculateEnergy(init_traj, make_calculator(directory), fmax=fmax, optimizer=optimizer, optimizer_kwargs=optimizer_kwargs,
+                                    surrogate=s, surrogate_fmax=surrogate_fmax).calculate_energy()
+            results[f'{mode}_time'] += time.perf_counter() - start_time
+            results[f'{mode}_steps'].append(steps)
+    results['saved_steps'] = sum(results['baseline_steps']) - sum(results['surrogate_steps'])
+    print(f'DFT steps without the surrogate: {sum(results["baseline_steps"])}, with the surrogate: {sum(results["surrogate_steps"])}, '
+          f'saved: {results["saved_steps"]} on {len(structures)} structures')
+    return results
+
+class WarmStart:
+    """
+    Start each SCF of a Quantum Espresso relaxation from the wavefunctions and charge density saved by the previous one.
+    The electronic state is saved in the outdir of the calculator, inside its directory (./warm_start by default),
+    so a restarted relaxation in the same directory also starts from the last SCF.
+    It is attached to the optimizer, which calls it after each SCF, and counts the SCF iterations from espresso.pwo.
+    The parameters of the calculator are changed during the relaxation, call restore after it,
+    so the next structure relaxed with the same calculator starts from scratch.
+    """
+    parameter_names = ('outdir', 'disk_io', 'startingwfc', 'startingpot')
+
+    def __init__(self, calculator, key=None):
+        """
+        calculator: ase.calculators.espresso.Espresso
+            The calculator of the relaxation, its parameters are updated to save and read the electronic state.
+        key: str
+            A name of the structure, if set, its electronic state is saved in outdir/key and its record in warm_start_key.json,
+            for the structures relaxed one after the other in the same directory. If None, the state belongs to the directory.
+        """
+        self.calculator = calculator
+        params = calculator.parameters
+        self.saved_parameters = {k: params[k] for k in self.parameter_names if k in params}
+        control = params.get('input_data', dict()).get('control', dict())
+        outdir = params.get('outdir', control.get('outdir', './warm_start'))
+        prefix = params.get('prefix', control.get('prefix', 'pwscf'))
+        if key is not None:
+            outdir = os.path.join(outdir, str(key))
+        # the flat parameters take precedence over input_data when ASE writes espresso.pwi
+        params['outdir'] = outdir
+        params['disk_io'] = 'low'
+        self.save_dir = os.path.join(calculator.directory, outdir, f'{prefix}.save')
+        self.record_path = os.path.join(calculator.directory, 'warm_start.json' if key is None else f'warm_start_{key}.json')
+        self.cold_iterations = None
+        if os.path.exists(self.record_path):
+            with open(self.record_path) as f:
+                self.cold_iterations = json.load(f)['cold_iterations']
+        self.scf_iterations = []
+        if self.has_saved_state():
+            self.use_saved_state()
+
+    def restore(self):
+        """
+        Put back the parameters of the calculator changed by the warm start.
+        """
+        for k in self.parameter_names:
+            self.calculator.parameters.pop(k, None)
+        self.calculator.parameters.update(self.saved_parameters)
+
+    def has_saved_state(self):
+        return os.path.isdir(self.save_dir) and any(f.startswith('charge-density') for f in os.listdir(self.save_dir))
+
+    def use_saved_state(self):
+        self.calculator.parameters['startingwfc'] = 'file'
+        self.calculator.parameters['startingpot'] = 'file'
+
+    def __call__(self):
+        iterations = scf_iterations(os.path.join(self.calculator.directory, 'espresso.pwo'))
+        if iterations is not None:
+            if self.cold_iterations is None and self.calculator.parameters.get('startingpot') != 'file':
+                # the first SCF from scratch is the reference of the iterations saved
+                self.cold_iterations = iterations
+                with open(self.record_path, 'w') as f:
+                    json.dump({'cold_iterations': iterations}, f)
+            else:
+                self.scf_iterations.append(iterations)
+        if self.has_saved_state():
+            self.use_saved_state()
+
+    def report(self):
+        """
+        Returns:
+            dict: the iterations of the warm started SCFs, of the SCF from scratch,
+            and the iterations saved compared to starting every SCF from scratch.
+        """
+        saved = sum(self.cold_iterations - i for i in self.scf_iterations) if self.cold_iterations is not None else None
+        return {'scf_iterations': self.scf_iterations, 'cold_iterations': self.cold_iterations, 'saved_iterations': saved}
+
+def scf_iterations(pwo_path):
+    """
+    Read the number of iterations of the last converged SCF in a Quantum Espresso output file.
+    Returns:
+        int or None: the number of iterations, None if no SCF converged.
+    """
+    if not os.path.exists(pwo_path):
+        return None
+    iterations = None
+    with open(pwo_path) as f:
+        for line in f:
+            if 'convergence has been achieved in' in line:
+                iterations = int(line.split('achieved in')[1].split()[0])
+    return iterations
+
+def ml_val(strut_ids, db_path, calculator,output_db, restart=False, processes=1, work_dir=None, chunk_size=10, stale_after=None):
     """
     This function performs DFT single point calculations on the ML predicted structures in the database.
+    Each row of the output database has a status key, "reserved", "running", "done" or "failed", and its status_time,
+    so the unfinished structures are found with one indexed query.
     strut_ids: list
         A list of structure ids in the initial structure database to calculate.
     db_path: str
@@ -118,29 +337,38 @@ def ml_val(strut_ids, db_path, calculator,output_db, restart=False):
         A flag to indicate if the calculation is a restart from a previous calculation, if set to True, 
         the function will read the output database and carry on to calculate the structures that are not validated.
         If set to True, the struct_ids variable will be ignored, so users can leave it as an empty list.
+    processes: int
+        The number of calculations run at the same time, each process gets its own copy of the calculator.
+        Set the command of the calculator so the processes share the nodes, e.g. the number of MPI ranks.
+    work_dir: str
+        If set, each calculation runs in its own directory work_dir/{STRUCTURE ID}, so the files of the calculators do not clash.
+        It defaults to "ml_val" when processes > 1.
+    chunk_size: int
+        The number of results written to the output database in each transaction.
+    stale_after: float
+        In restart mode, the "running" structures are calculated again if they started more than stale_after seconds ago,
+        e.g. the structures of a crashed job. If None, all the "running" structures are calculated again,
+        so do not restart while another job is still running on the same output database without setting it.
     """
     
     if restart:
         if not os.path.exists(output_db):
             raise FileNotFoundError(f'The output database {output_db} is not found, please make sure it exists.')
+        create_status_index(output_db)
         structs = []
-        restart_ids = []
         with connect(output_db) as db:
-            for row in db.select():
-                if not row.toatoms().get_chemical_formula():
-                    restart_ids.append(row.original_id)
+            restart_ids = unfinished_ids(db, stale_after)
         with connect(db_path) as db:
             for i in restart_ids:
                 row = db.get(id=i)
                 adslab = row.toatoms()
-                adslab.calc = calculator
                 structs.append((adslab, row.id, row.key_value_pairs))
     else:
         if os.path.exists(output_db):
+            create_status_index(output_db)
             with connect(output_db) as db:
-                for row in db.select():
-                    if not row.toatoms().get_chemical_formula():
-                        raise StructuresNotValidatedError('Some structures in the output database are not validated, run this function with restart mode.')
+                if unfinished_ids(db):
+                    raise StructuresNotValidatedError('Some structures in the output database are not validated, run this function with restart mode.')
 
         structs = []
         with connect(db_path) as db , connect(output_db) as db_out:
@@ -151,19 +379,99 @@ def ml_val(strut_ids, db_path, calculator,output_db, restart=False):
                     db_out.get(original_id=row.id)
                     logging.warning(f'Structure {row.id} is already calculated, skip it.')
                 except KeyError:
-                    db_out.reserve(original_id=row.id) # reserve the id to save the indices randomly sampled            
-                    adslab.calc = calculator
+                    db_out.reserve(original_id=row.id, status='reserved', status_time=time.time()) # reserve the id to save the indices randomly sampled            
                     structs.append((adslab, row.id, row.key_value_pairs))
-    for s, original_id, kvp in structs:
-        # # temperary solution for Ni magmom, will be deleted in the future
-        # for a in s:
-        #     if a.symbol == 'Ni':
-        #         a.magmom = 10.8
+        create_status_index(output_db)
+    if work_dir is None and processes > 1:
+        work_dir = 'ml_val'
+    tasks = [(calculator, s, original_id, kvp, os.path.join(work_dir, str(original_id)) if work_dir else None)
+             for s, original_id, kvp in structs]
+    db = connect(output_db)
+    with db:
+        indices = {row.original_id: row.id for row in db.select('original_id', columns=['id', 'key_value_pairs'], include_data=False)}
+        for _, original_id, _ in structs:
+            db.update(indices[original_id], status='running', status_time=time.time())
+    chunk = []
+    failed_num = 0
+    with Pool(processes) if processes > 1 else nullcontext() as pool:
+        results = pool.imap_unordered(single_point, tasks) if pool is not None else map(single_point, tasks)
+        for s, original_id, kvp in results:
+            failed_num += s is None
+            chunk.append((indices[original_id], s, kvp))
+            if len(chunk) >= chunk_size:
+                write_single_points(db, chunk)
+                chunk = []
+    write_single_points(db, chunk)
+    if failed_num:
+        logging.warning(f'{failed_num} calculations failed, run this function with restart mode to calculate them again.')
+
+def unfinished_ids(db, stale_after=None):
+    """
+    Find the structures of the output database that are not validated.
+    db: ase.db.core.Database
+        The output database of ml_val.
+    stale_after: float
+        Only count the "running" structures that started more than stale_after seconds ago, if None, all of them.
+    Returns:
+        list: the ids of the structures in the initial structure database.
+    """
+    ids = [row.original_id for row in db.select('status!=done', columns=['id', 'key_value_pairs'], include_data=False)
+           if row.status != 'running' or stale_after is None or row.status_time < time.time() - stale_after]
+    if db.count('status') < db.count():
+        # the rows reserved before the status key was added are the empty ones
+        ids.extend(row.original_id for row in db.select(columns=['id', 'numbers', 'key_value_pairs'], include_data=False)
+                   if 'status' not in row.key_value_pairs and len(row.numbers) == 0)
+    return ids
+
+def create_status_index(db_path):
+    """
+    Index the values of the text keys of an ASE SQLite database, so the rows are found by their status in one indexed query.
+    db_path: str
+        The path to the ASE database.
+    """
+    if not db_path.endswith('.db') or not os.path.exists(db_path):
+        return
+    with sqlite3.connect(db_path) as con:
+        con.execute('CREATE INDEX IF NOT EXISTS text_value_index ON text_key_values(key, value)')
+
+def single_point(task):
+    """
+    Run a single point calculation.
+    task: tuple
+        The calculator, the structure, its id in the initial structure database, its key_value_pairs and the directory to run in.
+    Returns:
+        tuple: (ase.Atoms, int, dict), the structure with a SinglePointCalculator, its id and its key_value_pairs.
+        If the calculation fails, the structure is None and the error message is returned instead of the key_value_pairs.
+    """
+    calculator, s, original_id, kvp, directory = task
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        # the pool works on pickled copies, copy it here too so the calculator passed to ml_val keeps its directory
+        calculator = copy.deepcopy(calculator)
+        calculator.directory = directory
+    # # temperary solution for Ni magmom, will be deleted in the future
+    # for a in s:
+    #     if a.symbol == 'Ni':
+    #         a.magmom = 10.8
+    s.calc = calculator
+    try:
         energy = s.get_potential_energy()
         forces = s.get_forces()
-        with connect(output_db) as db:
-            calc = SinglePointCalculator(s, energy=energy, forces=forces)
-            s.set_calculator(calc)
-            index = db.get(original_id=original_id).id
+    except Exception as e:
+        logging.error(f'The calculation of structure {original_id} failed: {e!r}')
+        return None, original_id, repr(e)[:200]
+    s.calc = SinglePointCalculator(s, energy=energy, forces=forces)
+    return s, original_id, kvp
+
+def write_single_points(db, chunk):
+    """
+    Write a chunk of single point results to the reserved rows of the output database in one transaction.
+    The rows of the failed calculations, without a structure, are marked as "failed".
+    """
+    with db:
+        for index, s, kvp in chunk:
+            if s is None:
+                db.update(index, status='failed', status_time=time.time(), error=kvp)
+                continue
             # db.write(s, original_id=original_id, key_value_pairs=kvp)
-            db.update(index, s, data=kvp)
+            db.update(index, s, delete_keys=['error'], data=kvp, status='done', status_time=time.time())
@@ -0,0 +1,101 @@
+import numpy as np
+
+class FrameSelector:
+    """
+    Select the frames of a relaxation to write to the training database.
+    The late frames of a relaxation are nearly identical, so a frame is only kept if it differs enough from the last kept frame.
+    The frames are read one at a time, only the kept frames are held in memory,
+    and farthest point sampling can then cut the kept frames of each relaxation to a fixed number.
+    The first frame is always kept, and the last frame too by default, since it is the relaxed structure.
+    """
+    def __init__(self, every=1, force_change=None, energy_change=None, max_frames=None, keep_last=True):
+        """
+        every: int
+            Only consider every Nth frame, counted from the first frame.
+        force_change: float
+            Keep a frame if the force on an atom changed by at least force_change (eV/A) since the last kept frame.
+        energy_change: float
+            Keep a frame if the energy changed by at least energy_change (eV) since the last kept frame.
+            If both thresholds are set, a frame is kept if it passes either one, if neither is set, all the considered frames are kept.
+        max_frames: int
+            The maximum number of frames kept from each relaxation, chosen by farthest point sampling on the positions, if None, no limit.
+        keep_last: bool
+            A flag to always keep the last frame.
+        """
+        if every < 1:
+            raise ValueError('every must be at least 1.')
+        if max_frames is not None and max_frames < 1 + keep_last:
+            raise ValueError(f'max_frames must be at least {1 + keep_last} to keep the first and the last frames.')
+        self.every = every
+        self.force_change = force_change
+        self.energy_change = energy_change
+        self.max_frames = max_frames
+        self.keep_last = keep_last
+
+    def changed(self, atoms, reference):
+        """
+        Check if the frame differs from the last kept frame by one of the thresholds.
+        reference: tuple
+            The (float, numpy.ndarray) energy and forces of the last kept frame.
+        """
+        if self.force_change is None and self.energy_change is None:
+            return True
+        if self.energy_change is not None and abs(atoms.get_potential_energy() - reference[0]) >= self.energy_change:
+            return True
+        if self.force_change is not None:
+            return np.linalg.norm(atoms.get_forces() - reference[1], axis=1).max() >= self.force_change
+        return False
+
+    def stream(self, frames):
+        """
+        Yield the frames passing the every and the threshold tests, without the farthest point sampling.
+        frames: iterable of ase.Atoms
+            The frames of one relaxation, e.g. an open ase.io.trajectory.Trajectory, they must have energies and forces.
+        """
+        reference = None
+        last = None
+        for i, atoms in enumerate(frames):
+            if reference is None or (i % self.every == 0 and self.changed(atoms, reference)):
+                reference = (atoms.get_potential_energy(), atoms.get_forces())
+                last = None
+                yield atoms
+            else:
+                last = atoms
+        if self.keep_last and last is not None:
+            yield last
+
+    def select(self, frames):
+        """
+        Select the frames of one relaxation.
+        frames: iterable of ase.Atoms
+            The frames of one relaxation, they must have energies and forces.
+        Returns:
+            list: the selected ase.Atoms in their order in the relaxation.
+        """
+        kept = list(self.stream(frames))
+        if self.max_frames is None or len(kept) <= self.max_frames:
+            return kept
+        descriptors = np.array([atoms.get_positions().reshape(-1) for atoms in kept])
+        return [kept[i] for i in farthest_point_sampling(descriptors, self.max_frames, [0, len(kept) - 1] if self.keep_last else [0])]
+
+def farthest_point_sampling(descriptors, n, start=(0,)):
+    """
+    Choose n points spread over the descriptor space, each new point is the farthest from the points already chosen.
+    descriptors: numpy.ndarray
+        The (number of points, descriptor length) descriptors.
+    n: int
+        The number of points to choose.
+    start: iterable of int
+        The indices of the points chosen first.
+    Returns:
+        list: the sorted indices of the chosen points.
+    """
+    chosen = list(dict.fromkeys(start))
+    distances = np.full(len(descriptors), np.inf)
+    for i in chosen:
+        distances = np.minimum(distances, np.linalg.norm(descriptors - descriptors[i], axis=1))
+    while len(chosen) < min(n, len(descriptors)):
+        i = int(np.argmax(distances))
+        chosen.append(i)
+        distances = np.minimum(distances, np.linalg.norm(descriptors - descriptors[i], axis=1))
+    return sorted(chosen)
@@ -1,4 +1,4 @@
-import time, yaml
+import time, yaml, random
 import numpy as np
 from fireworks import Firework, ScriptTask, LaunchPad
 
@@ -46,6 +46,99 @@ def is_generator_empty(generator):
     except StopIteration:
         return True
 
+def reservoir_sample(iterable, k, rng=random):
+    """
+    Randomly sample k items from an iterable of unknown length in a single pass and constant memory.
+    iterable: The items to sample from.
+    k: int
+        The number of items to sample.
+    rng: random.Random
+        The random number generator, the random module by default.
+    Returns:
+        tuple: (list, int), the sampled items and the number of items in the iterable.
+    """
+    samples = []
+    n = 0
+    for n, item in enumerate(iterable, 1):
+        if len(samples) < k:
+            samples.append(item)
+        else:
+            j = rng.randrange(n)
+            if j < k:
+                samples[j] = item
+    return samples, n
+
+def coverage_bin(coverages, ranges, bins=None):
+    """
+    Get the bin of a coverage combination on a regular grid over the coverage ranges.
+    coverages: tuple
+        The coverage of each adsorbate.
+    ranges: list
+        The (lower, upper) coverage range of each adsorbate.
+    bins: int or list
+        The number of bins for each adsorbate, if None, each coverage combination is its own bin.
+    Returns:
+        tuple: the bin index along each adsorbate.
+    """
+    if bins is None:
+        return tuple(coverages)
+    if isinstance(bins, int):
+        bins = [bins] * len(ranges)
+    index = []
+    for c, (lower, upper), n in zip(coverages, ranges, bins):
+        if upper <= lower:
+            index.append(0)
+        else:
+            index.append(min(max(int((c - lower) / (upper - lower) * n), 0), n - 1))
+    return tuple(index)
+
+def allocate_quotas(bin_counts, structure_num):
+    """
+    Split the number of structures to sample evenly between the bins, the share a bin is too small to fill goes to the other bins.
+    bin_counts: dict
+        The number of items in each bin.
+    structure_num: int
+        The total number of structures to sample.
+    Returns:
+        dict: the number of structures to sample from each bin.
+    """
+    quotas = dict()
+    remaining = structure_num
+    bins = sorted(bin_counts, key=lambda b: (bin_counts[b], b))
+    for i, b in enumerate(bins):
+        quotas[b] = min(bin_counts[b], remaining // (len(bins) - i))
+        remaining -= quotas[b]
+    return quotas
+
+def stratified_sample(items, structure_num, rng=random):
+    """
+    Sample the items with the same quota for every bin in a single pass, a reservoir of at most structure_num items is kept for each bin.
+    items: iterable of (tuple, object)
+        The bin and the item to sample.
+    structure_num: int
+        The total number of items to sample.
+    rng: random.Random
+        The random number generator, the random module by default.
+    Returns:
+        tuple: (list, dict), the sampled items and the number sampled from each bin.
+    """
+    reservoirs = dict()
+    counts = dict()
+    for b, item in items:
+        counts[b] = counts.get(b, 0) + 1
+        reservoir = reservoirs.setdefault(b, [])
+        if len(reservoir) < structure_num:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(counts[b])
+            if j < structure_num:
+                reservoir[j] = item
+    quotas = allocate_quotas(counts, structure_num)
+    samples = []
+    for b in sorted(quotas):
+        samples.extend(rng.sample(reservoirs[b], quotas[b]))
+    return samples, quotas
+
 def add_fw(commands, lpad_config, reset_date):
     """
     Add a firework to the launchpad.
@@ -0,0 +1,110 @@
+import sqlite3, time
+
+class WorkQueue:
+    """
+    A work queue of database row ids stored in a SQLite file, shared by worker processes on the same file system.
+    The workers claim small batches of ids until the queue is drained, so the fast workers take more ids than the slow ones.
+    Each id is "pending", "claimed" by a worker or "done", the claims of the workers that died can be reclaimed.
+    """
+    def __init__(self, path, timeout=60):
+        """
+        path: str
+            The path to the SQLite file of the queue, it is created if it does not exist.
+        timeout: float
+            The time in seconds to wait for the lock held by another worker.
+        """
+        self.path = path
+        self.timeout = timeout
+        with self.connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS work (id INTEGER PRIMARY KEY, state TEXT NOT NULL, worker TEXT, claimed_at REAL)')
+            con.execute('CREATE INDEX IF NOT EXISTS state_index ON work (state, id)')
+
+    def connect(self):
+        con = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        con.execute('PRAGMA busy_timeout = %d' % int(self.timeout * 1000))
+        return Transaction(con)
+
+    def add(self, ids):
+        """
+        Add ids to the queue, the ids already in the queue keep their state.
+        ids: iterable of int
+            The row ids to add.
+        """
+        with self.connect() as con:
+            con.executemany("INSERT OR IGNORE INTO work (id, state) VALUES (?, 'pending')", ((int(i),) for i in ids))
+
+    def claim(self, worker, size=16):
+        """
+        Claim the next pending ids.
+        worker: str
+            The name of the worker claiming the ids.
+        size: int
+            The maximum number of ids to claim.
+        Returns:
+            list: the claimed ids in ascending order, empty once the queue is drained.
+        """
+        with self.connect() as con:
+            ids = [i for i, in con.execute("SELECT id FROM work WHERE state = 'pending' ORDER BY id LIMIT ?", (size,))]
+            con.executemany("UPDATE work SET state = 'claimed', worker = ?, claimed_at = ? WHERE id = ?",
+                            ((str(worker), time.time(), i) for i in ids))
+        return ids
+
+    def complete(self, ids):
+        """
+        Mark the ids as done.
+        ids: iterable of int
+            The ids finished by the worker.
+        """
+        with self.connect() as con:
+            con.executemany("UPDATE work SET state = 'done' WHERE id = ?", ((int(i),) for i in ids))
+
+    def reclaim(self, timeout=None, worker=None):
+        """
+        Put the claimed ids back to pending, e.g. the ids of the workers killed by the wall time limit.
+        timeout: float
+            Only reclaim the ids claimed more than timeout seconds ago, if None, the age is not checked.
+        worker: str
+            Only reclaim the ids claimed by this worker, e.g. a worker restarting with the same name, if None, all workers.
+        Returns:
+            int: the number of reclaimed ids.
+        """
+        query = "UPDATE work SET state = 'pending', worker = NULL, claimed_at = NULL WHERE state = 'claimed'"
+        args = []
+        if timeout is not None:
+            query += ' AND claimed_at < ?'
+            args.append(time.time() - timeout)
+        if worker is not None:
+            query += ' AND worker = ?'
+            args.append(str(worker))
+        with self.connect() as con:
+            return con.execute(query, args).rowcount
+
+    def counts(self):
+        """
+        Count the ids in each state.
+        Returns:
+            dict: the number of "pending", "claimed" and "done" ids.
+        """
+        counts = {'pending': 0, 'claimed': 0, 'done': 0}
+        with self.connect() as con:
+            for state, n in con.execute('SELECT state, COUNT(*) FROM work GROUP BY state'):
+                counts[state] = n
+        return counts
+
+class Transaction:
+    """
+    Run the statements on a connection in one write transaction, the lock is taken at the start
+    so two workers can not claim the same ids, and the connection is closed at the end.
+    """
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        self.con.execute('BEGIN IMMEDIATE')
+        return self.con
+
+    def __exit__(self, exc_type, *args):
+        try:
+            self.con.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.con.close()
@@ -2,9 +2,28 @@
 
 """Tests for `caxpert` package."""
 
-import pytest
+import pytest, random, os, time
+from ase.db import connect
+from ase.io.trajectory import Trajectory
 from ase.build import fcc111, molecule, add_adsorbate
-from caxpert.src.tasks.gen_str import generate_structures, select_covs
+from ase.constraints import FixAtoms
+from caxpert.src.tasks import gen_str
+from caxpert.src.tasks.gen_str import generate_structures, select_covs, get_equivalence_classes
+from caxpert.src.utils.utils import stratified_sample, coverage_bin
+from caxpert.src.utils.work_queue import WorkQueue
+from caxpert.src.utils.frame_selection import FrameSelector, farthest_point_sampling
+from caxpert.src.tasks.run_dft import ml_val, WarmStart, CalculateEnergy, benchmark_surrogate
+from caxpert.src.tasks.job_farm import run_job_farm
+from caxpert.src.tasks.hull import LowerConvexHull
+from caxpert.src.tasks import inference
+from caxpert.src.tasks.inference import MLInfDataProcess, mk_inf_db
+from caxpert.src.tasks.make_db import MakeTrainingDB
+from multiprocessing import Pool
+from ase.calculators.singlepoint import SinglePointCalculator
+from caxpert.src.tasks.relax import BatchRelaxer, ASEBatchCalculator, ResultStore, get_optimizer, validate_batches, validation_dtype, surrogate_hessian, uses_hessian
+from ase.calculators.emt import EMT
+from ase.optimize import BFGS
+import numpy as np
 
 def test_generate_structures_one_ads():
     """
@@ -49,6 +68,744 @@ def test_generate_structures_two_ads():
     # # Check if the database is created
     # assert os.path.exists('init_structures.db')
 
+def make_prim_structure():
+    """
+    Make a tagged and constrained Ni(111) primitive structure with a CO adsorbate.
+    """
+    prim_structure = fcc111('Ni',size=(1,1,4), vacuum=13)
+    prim_structure.set_tags([0 for i in range(len(prim_structure))])
+    prim_structure[3].tag = 1
+    prim_structure.set_constraint(FixAtoms([0, 1]))
+    co = molecule('CO', vacuum=13, tags=[2,2])
+    add_adsorbate(prim_structure, co, 1.8, offset=(0, 0), mol_index=1)
+    return prim_structure, co
+
+def test_generate_structures_chunked_writes(tmp_path):
+    """
+    Test that the chunk size of the database writes does not change the stored structures.
+    """
+    assert_same_structures(tmp_path, dict(chunk_size=1), dict(chunk_size=1000))
+
+def test_generate_structures_parallel(tmp_path):
+    """
+    Test that decorating the structures in a process pool gives the same database as the serial path.
+    """
+    assert_same_structures(tmp_path, dict(processes=1), dict(processes=2, chunk_size=5))
+
+def test_generate_structures_resume(tmp_path, monkeypatch):
+    """
+    Test that an interrupted enumeration resumed from the database gives the same structures as an uninterrupted one.
+    """
+    write_chunk = gen_str.write_chunk
+    calls = []
+    def interrupted_write_chunk(db, chunk, **kwargs):
+        calls.append(len(chunk))
+        if len(calls) > 3:
+            raise KeyboardInterrupt
+        return write_chunk(db, chunk, **kwargs)
+    prim_structure, co = make_prim_structure()
+    ads_center_atom_ids = [a.index for a in prim_structure if a.symbol == 'C']
+    db_path = str(tmp_path / 'init_structures_resumed.db')
+    monkeypatch.setattr(gen_str, 'write_chunk', interrupted_write_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        generate_structures(prim_structure, [(co, 1)], ads_center_atom_ids, 6, db_path=db_path, chunk_size=2)
+    monkeypatch.setattr(gen_str, 'write_chunk', write_chunk)
+    prim_structure, co = make_prim_structure()
+    generate_structures(prim_structure, [(co, 1)], ads_center_atom_ids, 6, db_path=db_path, chunk_size=2, resume=True)
+
+    prim_structure, co = make_prim_structure()
+    ref_db_path = str(tmp_path / 'init_structures_ref.db')
+    generate_structures(prim_structure, [(co, 1)], ads_center_atom_ids, 6, db_path=ref_db_path)
+    with connect(db_path) as db, connect(ref_db_path) as ref_db:
+        rows = list(db.select())
+        ref_rows = list(ref_db.select())
+    assert len(rows) == len(ref_rows)
+    for r1, r2 in zip(ref_rows, rows):
+        assert r1.key_value_pairs == r2.key_value_pairs
+        assert r1.toatoms() == r2.toatoms()
+
+def test_generate_structures_skip_stored(tmp_path):
+    """
+    Test that skip_stored keeps every structure of a first enumeration, as ICET enumerates each equivalence class once,
+    and that enumerating again into the same database stores nothing new and counts the times each structure was enumerated.
+    """
+    prim_structure, co = make_prim_structure()
+    ads_center_atom_ids = [a.index for a in prim_structure if a.symbol == 'C']
+    generate_structures(prim_structure, [(co, 1)], ads_center_atom_ids, 5, db_path=str(tmp_path / 'ref.db'))
+    with connect(str(tmp_path / 'ref.db')) as ref_db:
+        ref_num = ref_db.count()
+    db_path = str(tmp_path / 'init_structures.db')
+    for i in range(2):
+        prim_structure, co = make_prim_structure()
+        generate_structures(prim_structure, [(co, 1)], ads_center_atom_ids, 5, db_path=db_path, skip_stored=True)
+        with connect(db_path) as db:
+            assert db.count() == len(get_equivalence_classes(db_path)) == ref_num
+    assert all([times_enumerated == 2 for _, times_enumerated in get_equivalence_classes(db_path).values()])
+
+def test_site_fingerprint_equivalent_structures():
+    """
+    Test that the structures equivalent by a lattice translation, with the atoms in another order, share the fingerprint
+    and that the structures with different occupations do not.
+    """
+    from ase import Atoms
+    from icet.tools import enumerate_structures
+    prim_structure = fcc111('Ni', size=(1, 1, 4), vacuum=13)
+    prim_structure += Atoms('O', positions=[prim_structure.positions[3] + [0, 0, 1.8]])
+    symmetry = gen_str.get_surface_symmetry(prim_structure)
+    rng = np.random.default_rng(0)
+    fingerprints = set()
+    for struct in enumerate_structures(prim_structure, [4], [['Ni']] * 4 + [['X', 'He']]):
+        fingerprint = gen_str.site_fingerprint(struct, symmetry, [0, 2])
+        fingerprints.add(fingerprint)
+        moved = struct.copy()
+        moved.positions += 2 * prim_structure.cell[0] + prim_structure.cell[1]
+        moved.wrap()
+        moved = moved[rng.permutation(len(moved))]
+        assert gen_str.site_fingerprint(moved, symmetry, [0, 2]) == fingerprint
+    assert len(fingerprints) == 8
+
+def test_select_covs_atom_num_constraint(tmp_path):
+    """
+    Test that the selected structures satisfy the coverage ranges and the size constraint.
+    """
+    prim_structure, co = make_prim_structure()
+    ads_center_atom_ids = [a.index for a in prim_structure if a.symbol == 'C']
+    db_path = str(tmp_path / 'init_structures.db')
+    generate_structures(prim_structure, [(co, 1)], ads_center_atom_ids, 6, db_path=db_path)
+    sample_ids = select_covs(db_path, {'co':(0.2, 1)}, 5, total_atom_num_constraint=20, output_db=str(tmp_path / 'dft_structures.db'))
+    assert len(sample_ids) == len(set(sample_ids)) == 5
+    with connect(db_path) as db:
+        for i in sample_ids:
+            row = db.get(id=i)
+            assert row.natoms <= 20
+            assert 0.2 <= row.co <= 1
+
+def test_stratified_sample():
+    """
+    Test that the stratified sampler fills the small bins and shares the rest between the large bins reproducibly.
+    """
+    covs = [(0.1, 0.0)] * 2 + [(0.5, 0.0)] * 50 + [(0.9, 0.9)] * 200
+    items = [(coverage_bin(c, [(0, 1), (0, 1)], 2), i) for i, c in enumerate(covs)]
+    samples, quotas = stratified_sample(items, 12, random.Random(0))
+    assert quotas == {(0, 0): 2, (1, 0): 5, (1, 1): 5}
+    assert len(set(samples)) == 12
+    assert samples == stratified_sample(items, 12, random.Random(0))[0]
+
+def make_slab(adsorbate='O', height=1.5, rattle=0.05, seed=0):
+    """
+    The Cu(111) slab of the EMT tests, with the bottom layer fixed, an adsorbate on the fcc site if set and the positions rattled.
+    """
+    slab = fcc111('Cu', size=(2, 2, 3), vacuum=8)
+    if adsorbate is not None:
+        add_adsorbate(slab, adsorbate, height, 'fcc')
+    slab.set_constraint(FixAtoms([a.index for a in slab if a.tag == 3]))
+    slab.rattle(rattle, seed=seed)
+    return slab
+
+def test_batch_relaxer():
+    """
+    Test that relaxing a batch of structures gives the same results as relaxing them one at a time, in the input order.
+    """
+    structures = []
+    for i in range(5):
+        structures.append((i, make_slab(height=1.5 + 0.1 * i, seed=i)))
+    relaxer = BatchRelaxer(ASEBatchCalculator(EMT()), batch_size=2, fmax=0.05, steps=50)
+    relaxed = list(relaxer.run((i, slab.copy()) for i, slab in structures))
+    assert [key for key, _, _ in relaxed] == list(range(5))
+    for (_, slab), (_, atoms, result) in zip(structures, relaxed):
+        slab.calc = EMT()
+        opt = BFGS(slab, logfile=None)
+        opt.run(fmax=0.05, steps=50)
+        assert result['converged'] and result['steps'] == opt.nsteps
+        assert np.allclose(slab.positions, atoms.positions)
+        assert np.isclose(slab.get_potential_energy(), result['energy'])
+
+@pytest.mark.parametrize('name', ['FIRE', 'LBFGS'])
+def test_batch_relaxer_optimizers(name):
+    """
+    Test that the batched relaxations give the same results as the serial ones with the other optimizers.
+    """
+    slab = make_slab(height=1.6, seed=1)
+    relaxer = BatchRelaxer(ASEBatchCalculator(EMT()), batch_size=2, fmax=0.05, steps=100, optimizer=name)
+    _, atoms, result = next(relaxer.run([(0, slab.copy())]))
+    slab.calc = EMT()
+    opt = get_optimizer(name)(slab, logfile=None)
+    opt.run(fmax=0.05, steps=100)
+    assert result['steps'] == opt.nsteps
+    assert np.allclose(slab.positions, atoms.positions)
+    with pytest.raises(ValueError):
+        BatchRelaxer(ASEBatchCalculator(EMT()), optimizer='PreconLBFGS')
+
+def test_result_store(tmp_path):
+    """
+    Test that the result store resumes from the last complete record and drops a partially written one.
+    """
+    slab = fcc111('Cu', size=(2, 2, 3), vacuum=8)
+    slab.calc = EMT()
+    store = ResultStore(str(tmp_path / 'ml_inf_1_to_11'))
+    with store:
+        for source_id in (3, 7):
+            store.append(source_id, slab, {'energy': slab.get_potential_energy(), 'fmax': 0.01, 'steps': source_id, 'converged': True})
+    with open(store.records_path, 'ab') as f:
+        f.write(b'partial')
+    with store:
+        store.append(9, slab, {'energy': 1.0, 'fmax': 0.1, 'steps': 300, 'converged': False})
+    records = store.read_records()
+    assert list(records['source_id']) == [3, 7, 9]
+    assert list(records['frame']) == [0, 1, 2]
+    assert list(records['converged']) == [True, True, False]
+    assert store.done_ids() == {3, 7, 9}
+
+def test_mk_inf_db(tmp_path):
+    """
+    Test that the relaxed structures are matched to gapped source ids, written once when the function is run again,
+    and that the rows of the batched relaxations name their calculator.
+    """
+    input_db = str(tmp_path / 'input.db')
+    with connect(input_db) as db:
+        for i in range(1, 7):
+            db.write(make_slab(seed=i), idx=i)
+        db.delete([2, 4])
+    def relaxed(source_id, batched):
+        slab = make_slab(seed=source_id)
+        slab.calc = EMT()
+        slab.get_forces()
+        if batched:
+            slab.calc = SinglePointCalculator(slab, energy=slab.get_potential_energy(), forces=slab.get_forces())
+        return slab
+    with ResultStore(str(tmp_path / 'ml_inf_1_to_4')) as store:
+        for source_id, steps in ((1, 5), (3, 5), (3, 6)):
+            store.append(source_id, relaxed(source_id, False), {'energy': 0.0, 'fmax': 0.01, 'steps': steps, 'converged': True})
+    with ResultStore(str(tmp_path / 'ml_inf_5_to_7'), calculator_name='emt') as store:
+        for source_id in (5, 3, 6):
+            store.append(source_id, relaxed(source_id, True), {'energy': 0.0, 'fmax': 0.01, 'steps': 99, 'converged': True})
+    output_db = str(tmp_path / 'output.db')
+    for _ in range(2):
+        mk_inf_db(input_db, str(tmp_path), output_db, chunk_size=2, processes=2)
+    rows = list(connect(output_db).select())
+    assert sorted(row.source_id for row in rows) == [1, 3, 5, 6]
+    for row in rows:
+        assert row.idx == row.source_id
+        assert row.calculator == 'emt'
+        assert np.isclose(row.energy, relaxed(row.source_id, False).get_potential_energy())
+    assert {row.source_id: row.relax_steps for row in rows} == {1: 5, 3: 6, 5: 99, 6: 99}
+
+def drain_queue(args):
+    queue_path, worker = args
+    queue = WorkQueue(queue_path)
+    taken = []
+    while True:
+        ids = queue.claim(worker, size=3)
+        if not ids:
+            return taken
+        taken.extend(ids)
+        queue.complete(ids)
+
+def test_work_queue(tmp_path):
+    """
+    Test that the workers drain the queue together and every id is claimed exactly once.
+    """
+    queue_path = str(tmp_path / 'queue.sqlite')
+    queue = WorkQueue(queue_path)
+    queue.add(range(1, 101))
+    queue.add(range(1, 11))
+    with Pool(4) as p:
+        taken = p.map(drain_queue, [(queue_path, w) for w in range(4)])
+    assert sorted(i for ids in taken for i in ids) == list(range(1, 101))
+    assert queue.counts() == {'pending': 0, 'claimed': 0, 'done': 100}
+    queue.add([101, 102])
+    assert queue.claim('dead', size=1) == [101]
+    assert queue.reclaim(timeout=3600) == 0
+    assert queue.reclaim(worker='dead') == 1
+    assert queue.claim('alive', size=5) == [101, 102]
+
+def relax_queue_worker(args):
+    input_db, queue_path, output_path, worker, batch_size = args
+    # EMT in place of the ML model, patched here since the pool processes run the worker
+    inference.get_calculator = lambda checkpoint_path, trainer: EMT()
+    inference.OCPBatchCalculator = ASEBatchCalculator
+    inference.ml_relax_queue(input_db, 'checkpoint.pt', queue_path, worker, output_path, claim_size=2, log_file=None,
+                             fmax=0.05, steps=50, batch_size=batch_size)
+
+def test_ml_relax_queue(tmp_path):
+    """
+    Test that the workers of ml_relax_queue relax every id of the queue exactly once, serially and in batches,
+    and that the merged database has every id.
+    """
+    input_db = str(tmp_path / 'input.db')
+    with connect(input_db) as db:
+        for i in range(9):
+            db.write(make_slab(height=1.5 + 0.05 * i, seed=i), idx=i)
+    ids = list(range(1, 10))
+    queue_path = str(tmp_path / 'queue.sqlite')
+    WorkQueue(queue_path).add(ids)
+    output_path = str(tmp_path / 'relaxed')
+    os.makedirs(output_path)
+    with Pool(3) as p:
+        p.map(relax_queue_worker, [(input_db, queue_path, output_path, worker, batch_size)
+                                   for worker, batch_size in ((1, 1), (2, 2), (3, 1))])
+    assert WorkQueue(queue_path).counts() == {'pending': 0, 'claimed': 0, 'done': 9}
+    relaxed_ids = [i for worker in (1, 2, 3)
+                   for i in ResultStore(os.path.join(output_path, f'ml_inf_{worker}_worker')).read_records()['source_id']]
+    assert sorted(relaxed_ids) == ids
+    output_db = str(tmp_path / 'output.db')
+    mk_inf_db(input_db, output_path, output_db)
+    rows = list(connect(output_db).select())
+    assert sorted(row.source_id for row in rows) == ids
+    assert all(row.idx == row.source_id - 1 and row.calculator == 'emt' for row in rows)
+
+def test_lower_convex_hull():
+    """
+    Test the hull on a line, on a plane with one adsorbate at a fixed coverage, and the incremental updates.
+    """
+    coverages = [[0.0], [0.25], [0.5], [0.5], [0.75], [1.0]]
+    energies = [0.0, -1.0, -1.2, -1.5, -0.5, 0.0]
+    hull = LowerConvexHull(coverages, energies, ids=[1, 2, 3, 4, 5, 6])
+    assert sorted(hull.ids) == [1, 2, 4, 6]
+    assert np.allclose(hull.energy_above_hull(coverages, energies), [0, 0, 0.3, 0, 0.25, 0])
+    assert np.isnan(hull.hull_energy([[1.5]])[0])
+    coverages_2d = np.column_stack([coverages, np.full(6, 0.25)])
+    assert np.allclose(LowerConvexHull(coverages_2d, energies).energy_above_hull(coverages_2d, energies), [0, 0, 0.3, 0, 0.25, 0])
+    rng = np.random.default_rng(0)
+    coverages = rng.integers(0, 5, size=(200, 2)) / 4
+    energies = rng.normal(size=200) + coverages.sum(axis=1) ** 2
+    hull = LowerConvexHull(coverages, energies)
+    above = hull.energy_above_hull(coverages, energies)
+    assert above.min() > -1e-8
+    assert np.allclose(above[hull.ids], 0)
+    incremental = LowerConvexHull(coverages[:100], energies[:100])
+    assert incremental.update(coverages[100:], energies[100:], np.arange(100, 200))
+    assert not incremental.update(coverages, energies + 1.0)
+    assert sorted(incremental.ids) == sorted(hull.ids)
+    single = LowerConvexHull([[0.25], [0.25]], [1.0, 0.5], ids=[1, 2])
+    assert list(single.ids) == [2]
+    assert np.allclose(single.energy_above_hull([[0.25]], [1.0]), [0.5])
+    assert np.isnan(single.hull_energy([[0.5]])[0])
+    assert single.update([[0.5]], [0.1], ids=[3])
+    assert sorted(single.ids) == [2, 3]
+    assert np.allclose(single.hull_energy([[0.375]]), [0.3])
+
+def write_coverage_row(db, co, energy):
+    from ase.calculators.singlepoint import SinglePointCalculator
+    slab = fcc111('Cu', size=(2, 2, 3), vacuum=8)
+    slab.calc = SinglePointCalculator(slab, energy=energy)
+    return db.write(slab, CO=co)
+
+def test_coverage_minima_cache(tmp_path):
+    """
+    Test that the cached coverage minima are reused while the database is unchanged,
+    updated from the new rows after an insert, and rebuilt after an update or a delete.
+    """
+    db_path = str(tmp_path / 'ml_inf.db')
+    cache_path = str(tmp_path / 'minima.npz')
+    with connect(db_path) as db:
+        for co, energy in [(0.25, -1.0), (0.25, -2.0), (0.5, -3.0), (0.5, -2.5), (0.75, -1.0)]:
+            write_coverage_row(db, co, energy)
+    queries = []
+    def minima(cache=cache_path):
+        process = MLInfDataProcess(db_path, ['CO'], 'Cu', 12, cache_path=cache)
+        read_columns = process.read_columns
+        def spy(query=None):
+            queries.append(query)
+            return read_columns(query)
+        process.read_columns = spy
+        m = process.get_coverage_minima()
+        return {c[0]: (e, i) for c, e, i in zip(m['coverages'].tolist(), m['energies'].tolist(), m['ids'].tolist())}
+    assert minima() == {0.25: (-2.0, 2), 0.5: (-3.0, 3), 0.75: (-1.0, 5)}
+    assert queries == [None]
+    queries.clear()
+    assert minima() == {0.25: (-2.0, 2), 0.5: (-3.0, 3), 0.75: (-1.0, 5)}
+    assert queries == []
+    with connect(db_path) as db:
+        write_coverage_row(db, 0.75, -1.5)
+        write_coverage_row(db, 1.0, 0.0)
+    assert minima() == minima(cache=False) == {0.25: (-2.0, 2), 0.5: (-3.0, 3), 0.75: (-1.5, 6), 1.0: (0.0, 7)}
+    assert queries == ['id>5', None]
+    queries.clear()
+    with connect(db_path) as db:
+        db.update(3, CO=1.0)
+    assert minima() == minima(cache=False) == {0.25: (-2.0, 2), 0.5: (-2.5, 4), 0.75: (-1.5, 6), 1.0: (-3.0, 3)}
+    assert queries == [None, None]
+    queries.clear()
+    with connect(db_path) as db:
+        db.delete([2])
+    assert minima() == minima(cache=False) == {0.25: (-1.0, 1), 0.5: (-2.5, 4), 0.75: (-1.5, 6), 1.0: (-3.0, 3)}
+    assert queries == [None, None]
+    json_path = str(tmp_path / 'ml_inf.json')
+    with connect(db_path) as db, connect(json_path) as json_db:
+        for row in db.select():
+            json_db.write(row, CO=row.CO)
+    process = MLInfDataProcess(json_path, ['CO'], 'Cu', 12, cache_path=cache_path)
+    m = process.get_coverage_minima()
+    assert sorted(m['energies'].tolist()) == [-3.0, -2.5, -1.5, -1.0]
+
+def test_validate_batches(tmp_path):
+    """
+    Test the streamed errors against the errors computed at once, with the batches not dividing the structures.
+    """
+    from ase.calculators.singlepoint import SinglePointCalculator
+    structures = []
+    rng = np.random.default_rng(0)
+    for i in range(5):
+        slab = make_slab(adsorbate=None, seed=i)
+        slab.calc = EMT()
+        energy, forces = slab.get_potential_energy(), slab.get_forces(apply_constraint=False)
+        slab.calc = SinglePointCalculator(slab, energy=energy + rng.normal(), forces=forces + rng.normal(size=forces.shape))
+        structures.append((i + 1, slab))
+    errors_path = str(tmp_path / 'errors.rec')
+    metrics, energies, energies_pred = validate_batches(structures, ASEBatchCalculator(EMT()), batch_size=2, errors_path=errors_path)
+    diff = np.concatenate([(ASEBatchCalculator(EMT()).calculate([s])[1][0] - s.get_forces(apply_constraint=False))[4:] for _, s in structures])
+    assert metrics['struct_num'] == 5
+    assert np.isclose(metrics['energy_mae'], np.abs(energies_pred - energies).mean())
+    assert np.isclose(metrics['force_mae'], np.abs(diff).mean())
+    assert np.isclose(metrics['force_rmse'], np.sqrt((diff ** 2).mean()))
+    errors = np.fromfile(errors_path, dtype=validation_dtype)
+    assert list(errors['id']) == [1, 2, 3, 4, 5]
+    assert np.allclose(errors['energy'], energies)
+    sampled_metrics, sampled, sampled_pred = validate_batches(structures, ASEBatchCalculator(EMT()), batch_size=2, plot_points=3, rng=random.Random(0))
+    assert sampled_metrics == metrics
+    assert len(sampled) == 3 and set(sampled) <= set(energies)
+    assert np.allclose(sampled_pred, energies_pred[[list(energies).index(e) for e in sampled]])
+
+def test_ml_val_parallel(tmp_path):
+    """
+    Test that the parallel single points match the serial ones and that the restart fills the reserved rows.
+    """
+    db_path = str(tmp_path / 'ml_inf.db')
+    with connect(db_path) as db:
+        for i in range(5):
+            db.write(make_slab(adsorbate=None, seed=i), cu=1.0, idx=i)
+    calc = EMT()
+    ml_val([1, 2, 3], db_path, calc, str(tmp_path / 'serial.db'), work_dir=str(tmp_path / 'serial'))
+    assert calc.directory == '.' and sorted(os.listdir(tmp_path / 'serial')) == ['1', '2', '3']
+    ml_val([1, 2, 3], db_path, EMT(), str(tmp_path / 'parallel.db'), processes=2, work_dir=str(tmp_path / 'calcs'), chunk_size=2)
+    with connect(str(tmp_path / 'serial.db')) as serial, connect(str(tmp_path / 'parallel.db')) as parallel:
+        for row in serial.select():
+            other = parallel.get(original_id=row.original_id)
+            assert np.isclose(row.energy, other.energy)
+            assert np.allclose(row.forces, other.forces)
+            assert row.data['idx'] == other.data['idx']
+    assert sorted(os.listdir(tmp_path / 'calcs')) == ['1', '2', '3']
+    with connect(str(tmp_path / 'parallel.db')) as db:
+        db.reserve(original_id=5)
+    ml_val([], db_path, EMT(), str(tmp_path / 'parallel.db'), restart=True, processes=2, work_dir=str(tmp_path / 'calcs'))
+    with connect(str(tmp_path / 'parallel.db')) as db:
+        assert db.get(original_id=5).natoms == 12
+        assert db.count() == 4
+        assert db.count(status='done') == 4
+
+def test_ml_val_status(tmp_path):
+    """
+    Test that the failed and stale running structures are found by their status and calculated again in restart mode.
+    """
+    from caxpert.src.utils.error import StructuresNotValidatedError
+    db_path = str(tmp_path / 'ml_inf.db')
+    with connect(db_path) as db:
+        for symbol in ['Cu', 'Si', 'Cu']:
+            db.write(fcc111(symbol, size=(2, 2, 3), vacuum=8, a=3.6))
+    output_db = str(tmp_path / 'val.db')
+    ml_val([1, 2], db_path, EMT(), output_db)
+    with connect(output_db) as db:
+        assert db.get(original_id=1).status == 'done'
+        assert db.get(original_id=2).status == 'failed'
+        db.update(db.get(original_id=2).id, atoms=None, status='running', status_time=0.0)
+    with pytest.raises(StructuresNotValidatedError):
+        ml_val([3], db_path, EMT(), output_db)
+    with connect(db_path) as db:
+        db.update(2, atoms=fcc111('Cu', size=(2, 2, 3), vacuum=8, a=3.6))
+    ml_val([], db_path, EMT(), output_db, restart=True, stale_after=3600)
+    with connect(output_db) as db:
+        assert db.get(original_id=2).status == 'done'
+        assert 'error' not in db.get(original_id=2).key_value_pairs
+
+class FlakyEMT(EMT):
+    """
+    A slow EMT calculator standing in for a DFT code, it fails once after a few calls when fail_after is set.
+    """
+    def __init__(self, fail_after=None, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_after = fail_after
+        self.calls = 0
+
+    def calculate(self, *args, **kwargs):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise RuntimeError('pw.x crashed')
+        time.sleep(0.002)
+        super().calculate(*args, **kwargs)
+
+def test_job_farm(tmp_path):
+    """
+    Test that the job farm relaxes the structures with at most max_jobs at once and retries a crashed relaxation from its last frame.
+    """
+    from ase.io import write
+    init_trajs = []
+    for i in range(4):
+        slab = make_slab(height=1.6, seed=i)
+        os.makedirs(tmp_path / str(i))
+        init_trajs.append(str(tmp_path / str(i) / 'init.traj'))
+        write(init_trajs[-1], slab)
+    crashed = set()
+    def make_calculator(directory):
+        if directory.endswith('2') and directory not in crashed:
+            crashed.add(directory)
+            return FlakyEMT(fail_after=3)
+        return FlakyEMT()
+    events = []
+    states = run_job_farm(init_trajs, make_calculator, max_jobs=2, retries=1, fmax=0.1,
+                          progress=lambda job, state, counts: events.append((job, state, counts)))
+    assert all(state == 'done' for state in states.values())
+    assert max(counts['running'] for _, _, counts in events) == 2
+    assert [state for job, state, _ in events if job == init_trajs[2]] == ['pending', 'running', 'failed', 'running', 'done']
+    for t in init_trajs:
+        assert os.path.exists(os.path.join(os.path.dirname(t), 'relax.traj'))
+
+def test_warm_start(tmp_path):
+    """
+    Test that the SCFs after the first one read the saved state, also after a restart, and that the saved iterations are counted.
+    """
+    class FakeEspresso:
+        name = 'espresso'
+        def __init__(self, directory):
+            self.directory = directory
+            self.parameters = {'input_data': {'control': {'disk_io': 'none'}}, 'disk_io': 'none'}
+        def scf(self, iterations):
+            os.makedirs(os.path.join(self.directory, 'warm_start', 'pwscf.save'), exist_ok=True)
+            open(os.path.join(self.directory, 'warm_start', 'pwscf.save', 'charge-density.dat'), 'w').close()
+            with open(os.path.join(self.directory, 'espresso.pwo'), 'w') as f:
+                f.write(f'     convergence has been achieved in  {iterations} iterations\n')
+    calc = FakeEspresso(str(tmp_path))
+    warm_start = WarmStart(calc)
+    assert calc.parameters['disk_io'] == 'low' and 'startingpot' not in calc.parameters
+    for iterations in (15, 6, 5):
+        calc.scf(iterations)
+        warm_start()
+    assert calc.parameters['startingwfc'] == 'file' and calc.parameters['startingpot'] == 'file'
+    assert warm_start.report() == {'scf_iterations': [6, 5], 'cold_iterations': 15, 'saved_iterations': 19}
+    calc = FakeEspresso(str(tmp_path))
+    warm_start = WarmStart(calc)
+    assert calc.parameters['startingpot'] == 'file'
+    calc.scf(4)
+    warm_start()
+    assert warm_start.report()['saved_iterations'] == 11
+
+def test_job_farm_restarts(tmp_path):
+    """
+    Test that a relaxation crashing twice carries on from the last frame of relax.traj each time,
+    and that the surrogate is passed through to the relaxations.
+    """
+    from ase.io import write
+    init_traj = str(tmp_path / 'init.traj')
+    write(init_traj, make_slab(height=1.6, seed=0))
+    calls = []
+    def make_calculator(directory):
+        calls.append(directory)
+        return FlakyEMT(fail_after=3) if len(calls) <= 2 else FlakyEMT()
+    states = run_job_farm([init_traj], make_calculator, retries=2, fmax=0.05)
+    assert states == {init_traj: 'done'} and len(calls) == 3
+    with Trajectory(init_traj) as traj:
+        assert len(traj) == 1
+    with Trajectory(str(tmp_path / 'relax.traj')) as traj:
+        # two crashed attempts of 3 frames each, then the frames of the finished attempt
+        assert len(traj) > 6
+        assert np.linalg.norm(traj[-1].get_forces(), axis=1).max() <= 0.05
+    os.makedirs(tmp_path / 'surrogate')
+    init_traj = str(tmp_path / 'surrogate' / 'init.traj')
+    write(init_traj, make_slab(height=1.6, seed=0))
+    run_job_farm([init_traj], lambda d: FlakyEMT(), fmax=0.05, make_surrogate=lambda d: EMT(asap_cutoff=True))
+    with open(tmp_path / 'surrogate' / 'ase.log') as f:
+        assert 'Surrogate steps' in f.read()
+
+class FakeEspressoEMT(EMT):
+    """
+    An EMT calculator named espresso that writes the files of a Quantum Espresso SCF,
+    with fewer iterations when it starts from the saved state.
+    """
+    name = 'espresso'
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self.starts = []
+
+    def calculate(self, *args, **kwargs):
+        super().calculate(*args, **kwargs)
+        warm = self.parameters.get('startingpot') == 'file'
+        self.starts.append(warm)
+        save_dir = os.path.join(self.directory, self.parameters['outdir'], 'pwscf.save')
+        os.makedirs(save_dir, exist_ok=True)
+        open(os.path.join(save_dir, 'charge-density.dat'), 'w').close()
+        with open(os.path.join(self.directory, 'espresso.pwo'), 'w') as f:
+            f.write(f'     convergence has been achieved in  {5 if warm else 15} iterations\n')
+
+def test_warm_start_structures(tmp_path):
+    """
+    Test that the structures relaxed one after the other with the same calculator each start from scratch
+    and that the parameters of the calculator are restored.
+    """
+    db_path = str(tmp_path / 'ml_inf.db')
+    with connect(db_path) as db:
+        for i in range(2):
+            slab = make_slab(seed=i)
+            slab.calc = EMT()
+            slab.get_forces()
+            db.write(slab)
+    calc = FakeEspressoEMT(str(tmp_path))
+    calc.parameters['startingwfc'] = 'atomic+random'
+    relax = CalculateEnergy.init_for_db(db_path, calc, fmax=0.1, warm_start=True)
+    starts = []
+    for i in (1, 2):
+        calc.starts = []
+        relax.calculate_energy_from_db(i, str(tmp_path / f'relax_{i}.traj'))
+        starts.append(calc.starts)
+        assert calc.parameters.get('startingwfc') == 'atomic+random' and 'startingpot' not in calc.parameters
+        assert 'outdir' not in calc.parameters and 'disk_io' not in calc.parameters
+    for s in starts:
+        assert len(s) > 1 and not s[0] and all(s[1:])
+    for i in (1, 2):
+        assert os.path.isdir(tmp_path / 'warm_start' / f'struct_{i}' / 'pwscf.save')
+        assert os.path.exists(tmp_path / f'warm_start_struct_{i}.json')
+    with open(tmp_path / 'ase.log') as f:
+        assert f.read().count('cold start: 15') == 2
+
+def test_surrogate_relaxation(tmp_path):
+    """
+    Test that the relaxation seeded by a surrogate takes fewer DFT steps than from scratch and ends at the same energy,
+    and that the Hessian is only computed for BFGS.
+    EMT stands in for DFT and EMT with the ASAP cutoff for the surrogate.
+    """
+    slab = make_slab()
+    results = benchmark_surrogate([slab], lambda d: EMT(), EMT(asap_cutoff=True), work_dir=str(tmp_path), fmax=0.01)
+    assert results['saved_steps'] > 0 and results['surrogate_steps'][0] < results['baseline_steps'][0]
+    energies = []
+    for mode in ('baseline', 'surrogate'):
+        with Trajectory(str(tmp_path / '0' / mode / 'relax.traj')) as traj:
+            energies.append(traj[-1].get_potential_energy())
+    assert abs(energies[1] - energies[0]) < 1e-2
+    with open(tmp_path / '0' / 'surrogate' / 'ase.log') as f:
+        assert 'with the surrogate Hessian' in f.read()
+    assert uses_hessian(get_optimizer('BFGS')) and not uses_hessian(get_optimizer('FIRE'))
+    hessian = surrogate_hessian(slab, EMT())
+    assert np.allclose(hessian, hessian.T) and np.linalg.eigvalsh(hessian).min() >= 1.0 - 1e-8
+
+def test_frame_selector(tmp_path):
+    """
+    Test that the frame selector keeps the first and last frames, reads the frames once, and applies each option.
+    """
+    slab = make_slab(rattle=0.1)
+    slab.calc = EMT()
+    BFGS(slab, trajectory=str(tmp_path / 'relax.traj'), logfile=None).run(fmax=0.01)
+    with Trajectory(str(tmp_path / 'relax.traj')) as traj:
+        frames = list(traj)
+    def ids(selector):
+        selected = selector.select(iter(frames))
+        return [next(i for i, f in enumerate(frames) if f is a) for a in selected]
+    n = len(frames)
+    assert ids(FrameSelector()) == list(range(n))
+    assert ids(FrameSelector(every=4)) == sorted(set(range(0, n, 4)) | {n - 1})
+    assert ids(FrameSelector(every=4, keep_last=False)) == list(range(0, n, 4))
+    kept = ids(FrameSelector(energy_change=0.01))
+    assert kept[0] == 0 and kept[-1] == n - 1 and len(kept) < n
+    energies = [frames[i].get_potential_energy() for i in kept[:-1]]
+    assert all(abs(a - b) >= 0.01 for a, b in zip(energies, energies[1:]))
+    assert len(ids(FrameSelector(force_change=0.05))) < n
+    kept = ids(FrameSelector(max_frames=5))
+    assert len(kept) == 5 and kept[0] == 0 and kept[-1] == n - 1
+    descriptors = np.array([[0.0], [0.1], [0.2], [1.0], [3.0]])
+    assert farthest_point_sampling(descriptors, 3) == [0, 3, 4]
+
+def count_adsorbates_networkx(atoms, gas_refs):
+    """
+    The adsorbate counting of MakeTrainingDB before the neighbour graph was vectorized, with NeighborList and networkx.
+    """
+    import networkx as nx
+    from collections import Counter
+    from ase.neighborlist import NeighborList
+    from ase.data import covalent_radii
+    nl = NeighborList([covalent_radii[i] for i in atoms.numbers], self_interaction=False, bothways=True)
+    nl.update(atoms)
+    G = nx.Graph()
+    for a in atoms:
+        if a.tag == 2:
+            G.add_node(a.index)
+            for j in nl.get_neighbors(a.index)[0]:
+                if atoms[j].tag != 1:
+                    G.add_edge(a.index, j)
+    counts = {ref.get_chemical_formula(): 0 for ref in gas_refs}
+    for node in nx.connected_components(G):
+        for ref in gas_refs:
+            if Counter(atoms[i].symbol for i in node) == Counter(ref.get_chemical_symbols()):
+                counts[ref.get_chemical_formula()] += 1
+    return counts
+
+def test_count_adsorbates(tmp_path, caplog):
+    """
+    Test the adsorbate counts against the NeighborList and networkx version on random adsorbate layers,
+    including two adsorbates bonded through a tag 0 atom, and the warning for the gas references with the same composition.
+    """
+    from ase import Atoms
+    from ase.calculators.singlepoint import SinglePointCalculator
+    gas_refs = [molecule('CO'), Atoms('H'), Atoms('O')]
+    with connect(str(tmp_path / 'gas.db')) as db:
+        for ref in gas_refs:
+            ref.calc = SinglePointCalculator(ref, energy=-1.0)
+            db.write(ref)
+    slab = fcc111('Cu', size=(3, 3, 3), vacuum=8)
+    slab.calc = SinglePointCalculator(slab, energy=-10.0)
+    with connect(str(tmp_path / 'slabs.db')) as db:
+        db.write(slab)
+    maker = MakeTrainingDB([], str(tmp_path / 'slabs.db'), str(tmp_path / 'gas.db'))
+    rng = np.random.default_rng(0)
+    for i in range(20):
+        slab = fcc111('Cu', size=(3, 3, 3), vacuum=8)
+        slab.set_tags(np.where(slab.get_tags() == 1, 1, 0))
+        n = len(slab)
+        for symbol in rng.choice(['CO', 'H', 'O'], size=4):
+            add_adsorbate(slab, molecule('CO')[::-1] if symbol == 'CO' else symbol, rng.uniform(1.0, 2.0), position=tuple(rng.uniform(0, 7, 2)))
+        tags = slab.get_tags()
+        tags[n:] = 2
+        slab.set_tags(tags)
+        assert maker.count_adsorbates(slab) == count_adsorbates_networkx(slab, gas_refs)
+    # the O and the H are both bonded to the tag 0 Cu atom between them, so they are one group matching no gas reference
+    slab = fcc111('Cu', size=(3, 3, 3), vacuum=8)
+    slab.set_tags(np.where(slab.get_tags() == 1, 1, 0))
+    add_adsorbate(slab, 'O', 2.0, position=(0.0, 0.0))
+    add_adsorbate(slab, 'Cu', 2.0, position=(1.8, 0.0))
+    add_adsorbate(slab, 'H', 2.0, position=(3.0, 0.0))
+    add_adsorbate(slab, 'H', 2.0, position=(6.0, 4.0))
+    slab.set_tags(list(slab.get_tags()[:-4]) + [2, 0, 2, 2])
+    assert maker.count_adsorbates(slab) == count_adsorbates_networkx(slab, gas_refs) == {'CO': 0, 'H': 1, 'O': 0}
+    co = molecule('CO')
+    co.calc = SinglePointCalculator(co, energy=-2.0)
+    with connect(str(tmp_path / 'gas.db')) as db:
+        db.write(co)
+    with caplog.at_level('WARNING'):
+        maker = MakeTrainingDB([], str(tmp_path / 'slabs.db'), str(tmp_path / 'gas.db'))
+    assert 'same composition' in caplog.text
+    assert maker.gas_ref_energies['CO'] == -2.0
+
+def assert_same_structures(tmp_path, *kwargs_list):
+    """
+    Generate the structures with each set of keyword arguments and check the databases are identical.
+    """
+    db_paths = []
+    for i, kwargs in enumerate(kwargs_list):
+        prim_structure, co = make_prim_structure()
+        ads_center_atom_ids = [a.index for a in prim_structure if a.symbol == 'C']
+        db_path = str(tmp_path / f'init_structures_{i}.db')
+        generate_structures(prim_structure, [(co, 1)], ads_center_atom_ids, 4, db_path=db_path, **kwargs)
+        db_paths.append(db_path)
+    with connect(db_paths[0]) as db:
+        ref_rows = list(db.select())
+    assert len(ref_rows) > 0
+    for db_path in db_paths[1:]:
+        with connect(db_path) as db:
+            rows = list(db.select())
+        assert len(rows) == len(ref_rows)
+        for r1, r2 in zip(ref_rows, rows):
+            assert r1.key_value_pairs == r2.key_value_pairs
+            assert r1.toatoms() == r2.toatoms()
+
 # test_generate_structures_one_ads()
 # test_generate_structures_two_ads()
 